@@ -0,0 +1,81 @@
+"""
+Generates synthetic confgen homes for benchmarking.
+
+    python benchmarks/generate.py /tmp/bench --depth 3 --fanout 10 --keys 20
+"""
+import os
+import random
+from os.path import join
+
+import click
+import yaml
+
+
+def generate(home, depth=2, fanout=5, keys=10, services=3, templates=3,
+             template_size=1024, seed=0):
+    """
+    Writes confgen.yaml, inventory and templates of a synthetic config home.
+
+    The infra tree has `depth` levels below the root with `fanout` children each,
+    every node on the last level runs `services` services. Every node has `keys`
+    inventory keys, every service `templates` templates of about `template_size`
+    bytes referencing random keys. Returns the number of leaves.
+    """
+    rnd = random.Random(seed)
+    service_names = ['service{}'.format(i) for i in range(services)]
+    hierarchy = ['GLOBAL'] + ['LEVEL{}'.format(i) for i in range(1, depth + 1)] + ['SERVICE']
+
+    def infra(level):
+        if level > depth:
+            return list(service_names)
+        return {'n{}'.format(i): infra(level + 1) for i in range(fanout)}
+
+    config = {'hierarchy': hierarchy, 'service': service_names, 'infra': infra(1)}
+    os.makedirs(home)
+    with open(join(home, 'confgen.yaml'), 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+
+    def inventory(path, level):
+        dst = join(home, 'inventory', *path)
+        os.makedirs(dst)
+        if not path:  # every key templates use is defined globally
+            values = {'key{}'.format(i): 'value{}'.format(i) for i in range(keys)}
+        else:  # about half of the keys override ones of the ancestors
+            values = {'key{}'.format(i): '/'.join(path) for i in rnd.sample(range(keys * 2), keys)}
+        with open(join(dst, 'config.yaml'), 'w') as f:
+            yaml.safe_dump(values, f, default_flow_style=False)
+        if level < depth:
+            for i in range(fanout):
+                inventory(path + ['n{}'.format(i)], level + 1)
+
+    inventory([], 0)
+
+    line = '{name} = {{{{ key{key} }}}} ({{{{ LEVEL1 }}}}/{{{{ SERVICE }}}})\n'
+    for service in service_names:
+        os.makedirs(join(home, 'templates', service))
+        for t in range(templates):
+            content, size = [], 0
+            while size < template_size:
+                content.append(line.format(name='option{}'.format(len(content)),
+                                           key=rnd.randrange(keys)))
+                size += len(content[-1])
+            with open(join(home, 'templates', service, 'template{}.conf'.format(t)), 'w') as f:
+                f.write(''.join(content))
+    return fanout ** depth * services
+
+
+@click.command()
+@click.argument('home', type=click.Path(exists=False))
+@click.option('--depth', default=2, type=click.IntRange(1),
+              help='Levels of the infra tree below the root')
+@click.option('--fanout', default=5, help='Children of every node')
+@click.option('--keys', default=10, help='Inventory keys per node')
+@click.option('--services', default=3, help='Services running on every node of the last level')
+@click.option('--templates', default=3, help='Templates per service')
+@click.option('--template-size', default=1024, help='Approximate size of a template in bytes')
+def main(home, **kwargs):
+    print('generated {} leaves in {}'.format(generate(home, **kwargs), home))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Times the phases of confgen on a synthetic config home.
+
+    python benchmarks/run.py --depth 3 --fanout 10 --output results.json
+
+Every phase is run --repeat times and the fastest wall time is reported, along
+with the peak of memory allocated during the phase (python 3 only). Phases drop
+what previous runs left in memory (compiled templates, rendered outputs, search
+indexes) so every run does the work of a command, not cache lookups.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from os.path import join
+
+import click
+import tabulate
+
+from confgen import inventory, output
+from confgen.logic import ConfGen
+
+from generate import generate
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def measure(fn, repeat):
+    """
+    Returns the best wall time of repeat runs and the peak memory in bytes allocated
+    during one more run (tracing allocations slows the code down a lot)
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = timer()
+        fn()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if tracemalloc is None:
+        return best, None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        return best, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def phases(home, jobs):
+    """
+    Yields (name, callable) of the benchmarked phases, in the order they run
+    """
+    config_path = join(home, 'confgen.yaml')
+    confgen = ConfGen(home, open(config_path))
+    land_dir = join(home, ConfGen.build_dir)
+
+    rendered = []
+
+    def parse():
+        with open(config_path) as f:
+            return inventory.yaml_load(f)
+
+    def resolve():
+        confgen.root.invalidate()
+        confgen.resolve_inventories()
+
+    def render():
+        # compiled once per build, as by ConfGen.build
+        confgen.renderer.reset()
+        confgen.renderer.prepare()
+        rendered[:] = confgen.render_leaves(confgen.root.leaves, jobs)
+
+    def search(kind, pattern):
+        confgen.inventory._indexes.clear()  # built once per command
+        return getattr(confgen.inventory, 'search_' + kind)(pattern)
+
+    def write(rendered):
+        writer = output.DirectoryWriter(land_dir)
+        for node, templates in zip(confgen.root.leaves, rendered):
+            for filename, (content, entry) in templates.items():
+                writer.write(join(node.path.lstrip('/'), filename), content, entry)
+        writer.close()
+
+    def write_clean(rendered):
+        shutil.rmtree(land_dir, ignore_errors=True)
+        write(rendered)
+
+    leaf = confgen.root.leaves[-1]
+    yield 'config parse', parse
+    yield 'tree build', lambda: confgen.build_tree(confgen.config['infra'])
+    yield 'inventory collect', lambda: inventory.Inventory(confgen.root, home)
+    yield 'inventory resolve', resolve
+    yield 'render', render
+    yield 'write', lambda: write_clean(rendered)
+    yield 'write (unchanged)', lambda: write(rendered)
+    yield 'set', lambda: confgen.set(leaf.parent.path, 'benchmark', 'value')
+    yield 'search key', lambda: search('key', 'n1/n2')
+    yield 'search value', lambda: search('value', 'value1')
+    yield 'cli startup', lambda: subprocess.check_call(
+        [sys.executable, '-m', 'confgen.cli', '--ct-home', home, '--config', config_path,
+         '--no-cache', 'version'], stdout=open(os.devnull, 'w'))
+
+
+@click.command()
+@click.option('--home', type=click.Path(exists=True, file_okay=False),
+              help='Benchmark a copy of an existing config home instead of a generated one')
+@click.option('--depth', default=2, type=click.IntRange(1),
+              help='Levels of the infra tree below the root')
+@click.option('--fanout', default=5, help='Children of every node')
+@click.option('--keys', default=10, help='Inventory keys per node')
+@click.option('--services', default=3, help='Services running on every node of the last level')
+@click.option('--templates', default=3, help='Templates per service')
+@click.option('--template-size', default=1024, help='Approximate size of a template in bytes')
+@click.option('--jobs', default=1, help='Processes rendering templates')
+@click.option('--repeat', default=3, help='Runs of every phase')
+@click.option('--output', 'output_file', type=click.File('w'),
+              help='Write the results as JSON')
+def main(home, jobs, repeat, output_file, **params):
+    # phases rewrite the build dir and the inventory: never run them on a real home
+    tmp = tempfile.mkdtemp()
+    copy = join(tmp, 'home')
+    try:
+        if home is None:
+            generate(copy, **params)
+        else:
+            shutil.copytree(home, copy, ignore=shutil.ignore_patterns('.git'))
+        results = []
+        for name, fn in phases(copy, jobs):
+            elapsed, peak = measure(fn, repeat)
+            results.append({'phase': name, 'seconds': elapsed, 'peak_bytes': peak})
+    finally:
+        shutil.rmtree(tmp)
+
+    print(tabulate.tabulate(
+        [(i['phase'], '{:.4f}'.format(i['seconds']),
+          '-' if i['peak_bytes'] is None else '{:.1f}'.format(i['peak_bytes'] / 1024.0 ** 2))
+         for i in results],
+        ['phase', 'seconds', 'peak MiB'], tablefmt='psql'))
+    if output_file is not None:
+        json.dump({'params': params if home is None else {'home': home}, 'jobs': jobs,
+                   'results': results}, output_file, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
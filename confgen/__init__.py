@@ -1,5 +1,7 @@
 import os
+import errno
 import shutil
+import threading
 
 __version__ = '0.7.0'
 
@@ -16,3 +18,67 @@ def dir_rm(path):
             pass
         else:
             raise
+
+
+def user_cache_dir(name):
+    """
+    Returns the cache dir of the application name for the current user, under
+    $XDG_CACHE_HOME (~/.cache by default)
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, name)
+
+
+def mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if not exc.errno == errno.EEXIST:
+            raise
+
+
+def temp_path(path):
+    """
+    Returns a temporary name next to path, distinct for every process and thread
+    """
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+
+
+def prune_empty(path, top):
+    """
+    Removes path and then its parents as long as they are empty, up to top (excluded)
+    """
+    while path.startswith(top) and path != top:
+        try:
+            os.rmdir(path)
+        except OSError:  # not empty (or gone already)
+            return
+        path = os.path.dirname(path)
+
+
+def atomic_write(path, data, fsync=False, mode=None):
+    """
+    Writes data (bytes) to a temporary file next to path and renames it over path,
+    so readers see either the old or the new content, never a partial file.
+    With fsync the data is on disk before the rename. The file gets mode if given,
+    else the permissions of the file it replaces.
+    """
+    tmp = temp_path(path)
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp, mode)
+        else:
+            try:  # keep permissions of the file being replaced
+                shutil.copymode(path, tmp)
+            except OSError:
+                pass
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
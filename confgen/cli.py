@@ -1,13 +1,59 @@
+import os
+import sys
 import click
 import logging
+import functools
+
+try:
+    from os import cpu_count
+except ImportError:  # python 2
+    from multiprocessing import cpu_count
 
-from .logic import ConfGen
 from . import __version__
 
+# Only what every command needs is imported here: yaml, jinja2 and tabulate are
+# imported by the commands using them, so e.g. `confgen version` starts fast.
+
 logging.basicConfig(format='[%(levelname)s] %(message)s')
 log = logging.getLogger('confgen')
 
 
+class Loader(object):
+    """
+    Loads the ConfGen of the config home when a command first asks for it
+    """
+
+    def __init__(self, ct_home, config, cache, timings=None):
+        self.ct_home = ct_home
+        self.config = config
+        self.cache = cache
+        self.timings = timings
+        self.confgen = None
+
+    def load(self):
+        if self.confgen is not None:
+            return self.confgen
+        from .logic import ConfGen
+        if self.timings is None:
+            # commands read only the inventory files they need
+            self.confgen = ConfGen(self.ct_home, self.config, cache=self.cache, lazy=True)
+        else:
+            load = self.timings.timed('load config', ConfGen)
+            self.confgen = load(self.ct_home, self.config, cache=self.cache, lazy=True)
+            self.timings.instrument(self.confgen)
+        return self.confgen
+
+
+def pass_confgen(f):
+    """
+    Like click.pass_obj, but passes the ConfGen loaded by the Loader of the group
+    """
+    @click.pass_context
+    def new_func(ctx, *args, **kwargs):
+        return ctx.invoke(f, ctx.find_object(Loader).load(), *args, **kwargs)
+    return functools.update_wrapper(new_func, f)
+
+
 @click.group()
 @click.option('--ct-home', envvar='CG_HOME', default='.',
               type=click.Path(exists=True, file_okay=False, resolve_path=True),
@@ -15,13 +61,34 @@ log = logging.getLogger('confgen')
 @click.option('--config', default='confgen.yaml', envvar='CG_CONFIG',
               help='Defaults to confgen.yaml in current directory',
               type=click.File('r'))
+@click.option('--cache/--no-cache', default=True, envvar='CG_CACHE',
+              help='Keep compiled templates and parsed inventory in the user cache dir '
+                   '($XDG_CACHE_HOME/confgen)')
+@click.option('--timings', type=click.Choice(['table', 'json']),
+              help='Print the time spent in every phase, and the slowest templates and '
+                   'leaves, to stderr')
+@click.option('--profile', type=click.Path(dir_okay=False, writable=True),
+              help='Profile the command with cProfile and save the stats to this file')
 @click.pass_context
-def cli(ctx, ct_home, config):
-    ctx.obj = ConfGen(ct_home, config)
+def cli(ctx, ct_home, config, cache, timings, profile):
+    if profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def save_profile():
+            profiler.disable()
+            profiler.dump_stats(profile)
+        ctx.call_on_close(save_profile)
+    ctx.obj = Loader(ct_home, config, cache)
+    if timings is not None:
+        from .timings import Timings
+        recorder = ctx.obj.timings = Timings()
+        ctx.call_on_close(lambda: click.echo(recorder.format(timings), err=True))
 
 
 @cli.command()
-@click.pass_obj
+@pass_confgen
 def inventory(ctx):
     print(ctx.entire_inventory())
 
@@ -33,29 +100,124 @@ def search():
 
 @search.command()
 @click.argument('pattern')
-@click.pass_obj
+@pass_confgen
 def key(ctx, pattern):
     print(ctx.search_key(pattern))
 
 
 @search.command()
 @click.argument('pattern')
-@click.pass_obj
+@pass_confgen
 def value(ctx, pattern):
     print(ctx.search_value(pattern))
 
 
 @cli.command()
-@click.pass_obj
-def build(ctx):
-    ctx.build()
+@click.option('--jobs', '-j', default=cpu_count() or 1, type=click.IntRange(1),
+              help='Number of processes rendering templates (defaults to the number of CPUs)')
+@click.option('--path', '-p', 'paths', multiple=True,
+              help='Build only the leaves below this path, may be a glob (e.g. /prod/*, '
+                   'wildcards don\'t match /) and given multiple times')
+@click.option('--inflight', default=256, type=click.IntRange(1),
+              help='Leaves rendered ahead of writing their outputs at most')
+@click.option('--output', '-o',
+              help='Write the outputs into a tar, tar.gz or zip archive instead of the '
+                   'build dir, - for a tar on stdout')
+@click.option('--format', 'archive_format', type=click.Choice(('tar', 'tar.gz', 'zip')),
+              help='Archive format, guessed from the --output extension by default')
+@click.option('--store/--no-store', default=False,
+              help='Hardlink identical outputs to a single copy kept in .confgen-store '
+                   'in the config home')
+@click.option('--write-threads', default=4, type=click.IntRange(0),
+              help='Threads writing files while templates are rendered (0 writes them '
+                   'in turn)')
+@click.option('--durable/--fast', default=False,
+              help='fsync written files and their directories before the build ends')
+@pass_confgen
+def build(ctx, jobs, paths, inflight, output, archive_format, store, write_threads, durable):
+    from .output import ArchiveWriter
+    from .view import RenderError
+    try:
+        if output is None:
+            ctx.build(jobs=jobs, paths=paths or None, inflight=inflight, store=store,
+                      write_threads=write_threads, durable=durable)
+            return
+        archive_format = archive_format or ArchiveWriter.format_of(output)
+    except (RenderError, ValueError) as e:
+        log.error(e)
+        sys.exit(1)
+    try:
+        with click.open_file(output, 'wb') as archive:
+            ctx.build(jobs=jobs, paths=paths or None, inflight=inflight,
+                      archive=archive, archive_format=archive_format)
+    except (RenderError, ValueError) as e:
+        log.error(e)
+        if output != '-' and os.path.isfile(output):
+            os.unlink(output)  # an incomplete archive
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('path')
+@click.argument('template')
+@pass_confgen
+def render(ctx, path, template):
+    """
+    Prints one output, e.g. confgen render /prod/main/webapp my.cnf
+    """
+    from .view import RenderError
+    try:
+        click.echo(ctx.render(path, template), nl=False)
+    except KeyError as e:
+        log.error(e.args[0])
+        sys.exit(1)
+    except RenderError as e:
+        log.error(e)
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--jobs', '-j', default=cpu_count() or 1, type=click.IntRange(1),
+              help='Number of processes rendering templates on the first build')
+@click.option('--interval', default=0.5, type=float,
+              help='Seconds between checks for changes')
+@pass_confgen
+def watch(ctx, jobs, interval):
+    """
+    Rebuilds the outputs affected by changes to the inventory, templates or confgen.yaml
+    """
+    from .watch import Watcher
+    Watcher(ctx, interval).run(jobs=jobs)
+
+
+@cli.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', default=8642, type=click.IntRange(0, 65535), help='Port to listen on')
+@click.option('--cache-size', default=1024, type=click.IntRange(1),
+              help='Rendered outputs kept in memory')
+@click.option('--interval', default=0.5, type=float,
+              help='Seconds between checks for changes')
+@pass_confgen
+def serve(ctx, host, port, cache_size, interval):
+    """
+    Serves rendered outputs over HTTP: GET /<path>/<template>
+    """
+    from .serve import ConfigServer, make_server
+    server = make_server(ConfigServer(ctx, cache_size, interval), host, port)
+    print("serving {} on http://{}:{}/".format(ctx.home, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 @cli.command()
 @click.argument('path')
 @click.argument('key')
 @click.argument('value')
-@click.pass_obj
+@pass_confgen
 def set(ctx, path, key, value):
     ctx.set(path, key, value)
 
@@ -63,11 +225,43 @@ def set(ctx, path, key, value):
 @cli.command()
 @click.argument('path')
 @click.argument('key')
-@click.pass_obj
+@pass_confgen
 def delete(ctx, path, key):
     ctx.delete(path, key)
 
 
+@cli.group()
+def cache():
+    pass
+
+
+@cache.command()
+@pass_confgen
+def warm(ctx):
+    print("compiled {} templates".format(ctx.warm_cache()))
+
+
+@cache.command()
+@pass_confgen
+def clear(ctx):
+    ctx.clear_cache()
+
+
+@cli.command()
+@click.argument('operations', type=click.File('r'), default='-')
+@pass_confgen
+def apply(ctx, operations):
+    """
+    Applies set/delete operations read from a YAML or JSON lines file (or stdin)
+    """
+    from .inventory import read_operations
+    try:
+        ctx.apply(read_operations(operations))
+    except ValueError as e:
+        log.error(e)
+        sys.exit(1)
+
+
 @cli.command()
 def version():
     print(__version__)
@@ -1,18 +1,132 @@
 import re
-import errno
 import os
+import json
+import pickle
 from os.path import join
+from logging import getLogger
 
 import yaml
 
-from . import dir_rm
+from . import atomic_write, mkdir_p, prune_empty
+from .search import SearchIndex
 
-def mkdir_p(path):
+log = getLogger(__name__)
+
+# cache dirs that couldn't be written, warned about once
+_unwritable = set()
+
+try:  # LibYAML bindings are much faster, but optional
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+def yaml_load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def yaml_dump(data):
+    return yaml.dump(data, Dumper=SafeDumper, default_flow_style=False, encoding='utf-8')
+
+
+def read_operations(stream):
+    """
+    Reads inventory operations, e.g. {op: set, path: /prod, key: foo, value: bar}
+    or {op: delete, path: /prod, key: foo}, from a JSON lines or YAML stream
+    (a list of operations or a document per operation).
+    """
+    text = stream.read()
+    lines = [i.strip() for i in text.splitlines() if i.strip()]
+    if lines and all(i.startswith('{') for i in lines):
+        try:
+            return [json.loads(i) for i in lines]
+        except ValueError:  # YAML in flow style, e.g. {op: set, path: /prod, ...}
+            pass
+    operations = []
+    try:
+        for doc in yaml.load_all(text, Loader=SafeLoader):
+            if doc is None:
+                continue
+            operations.extend(doc if isinstance(doc, list) else [doc])
+    except yaml.YAMLError as e:
+        raise ValueError("cannot parse operations: {}".format(e))
+    return operations
+
+
+def write_cache(path, data):
+    """
+    Writes data to the cache file path, returns whether it could. A cache that can't
+    be written only gets a warning, commands go on without it.
+    """
+    directory = os.path.dirname(path)
     try:
-        os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if not exc.errno == errno.EEXIST:
-            raise
+        mkdir_p(directory)
+        atomic_write(path, data)
+    except (IOError, OSError) as e:
+        if directory not in _unwritable:
+            _unwritable.add(directory)
+            log.warning('Cache disabled, cannot write {} ({})'.format(path, e))
+        return False
+    return True
+
+
+class ParsedCache(object):
+    """
+    Parsed inventory files pickled between runs, keyed by file path.
+
+    An entry is used only while the file's size and mtime are unchanged.
+    Without a path nothing is cached and every file is parsed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.seen = {}
+        self.changed = False
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    self.entries = pickle.load(f)
+            except Exception:  # no cache yet, or unreadable - start over
+                self.entries = {}
+
+    def load(self, filename):
+        if self.path is None:
+            with open(filename) as f:
+                return yaml_load(f) or {}
+        st = os.stat(filename)
+        stamp = (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+        entry = self.entries.get(filename)
+        if entry is not None and entry[0] == stamp:
+            self.seen[filename] = entry
+            return pickle.loads(entry[1])
+        with open(filename) as f:
+            parsed = yaml_load(f) or {}
+        # kept pickled so modifying the inventory in place doesn't touch the cache
+        self.seen[filename] = (stamp, pickle.dumps(parsed, 2))
+        self.changed = True
+        return parsed
+
+    def stamp(self, filename):
+        return self.seen[filename][0]
+
+    def save(self, prune=True):
+        """
+        Stores entries of the files loaded since the cache was read. With prune (after
+        reading every file) the rest are dropped, else they are kept.
+        """
+        if self.path is None:
+            return
+        if prune:
+            entries = self.seen
+        else:
+            entries = dict(self.entries)
+            entries.update(self.seen)
+        if not (self.changed or len(entries) != len(self.entries)):
+            return
+        write_cache(self.path, pickle.dumps(entries, 2))
+        self.entries, self.changed = entries, False
+
 
 class Inventory(object):
     """
@@ -26,11 +140,24 @@ class Inventory(object):
     config_filename = 'config.yaml'
     source_key_pattern = '{key}__source'
 
-    def __init__(self, tree, home=None):
+    def __init__(self, tree, home=None, cache_dir=None, lazy=False):
         self.home = home
         self.inventory_dir = join(home, 'inventory')
+        self.cache_dir = cache_dir
         self._tree = tree
-        self.__collect()
+        # nodes modified since the last flush, by path (nodes aren't hashable)
+        self._dirty = {}
+        self._cache = ParsedCache(join(cache_dir, 'inventory') if cache_dir else None)
+        # inventory file loaded into each node, by path
+        self._sources = {}
+        # search indexes, built on first search
+        self._indexes = {}
+        self._modified = False
+        # paths of the nodes whose inventory file was looked for
+        self._loaded = set()
+        self._collected = False
+        if not lazy:
+            self.collect()
 
     def _parse_file_path(self, path):
         """
@@ -38,63 +165,203 @@ class Inventory(object):
         """
         return path[len(self.inventory_dir):]
 
-    def __collect(self):
+    def collect(self, nodes=None):
         """
-        Walks to home dir and collects yaml files
+        Walks to home dir and collects yaml files.
+
+        With nodes, only the files of those nodes and their ancestors are read, the
+        rest is collected by the first call without nodes. Everything that reads or
+        changes the whole inventory calls it first.
         """
+        if self._collected:
+            return
+        if nodes is not None:
+            for node in nodes:
+                for n in node.up():
+                    if n.path not in self._loaded:
+                        self._load(n, join(self.inventory_dir, n.path.lstrip('/'),
+                                           self.config_filename))
+            # the files of the other nodes stay cached
+            self._cache.save(prune=False)
+            return
         for path, dirs, files in os.walk(self.inventory_dir):
-            if files:
-                configyml = yaml.load(open(join(path, self.config_filename))) or {}
+            if self.config_filename in files:
                 try:
-                    self._tree.by_path(self._parse_file_path(path)).inventory = configyml
+                    node = self._tree.by_path(self._parse_file_path(path))
                 except KeyError:
                     # XXX
                     # something in the inventory that doesn't make sense
                     # a path that doesn't exist in the infra tree but is present
                     # in the inventory
-                    pass
+                    continue
+                if node.path not in self._loaded:
+                    self._load(node, join(path, self.config_filename))
+        self._cache.save()
+        self._collected = True
+
+    def _load(self, node, filename):
+        self._loaded.add(node.path)
+        if os.path.isfile(filename):
+            node.inventory = self._cache.load(filename)
+            self._sources[node.path] = filename
+
+    def reload(self, filename):
+        """
+        Reads an inventory file changed on disk (or removed) again, returns the node
+        it belongs to or None if it doesn't belong to any
+        """
+        self.collect()
+        try:
+            node = self._tree.by_path(self._parse_file_path(os.path.dirname(filename)))
+        except KeyError:
+            return None
+        if os.path.isfile(filename):
+            node.inventory = self._cache.load(filename)
+            self._sources[node.path] = filename
+        else:
+            node.inventory = {}
+            self._sources.pop(node.path, None)
+        self._cache.save()
+        self._indexes.clear()
+        return node
 
     def set(self, path, key, value):
         """
         Add a value to the inventory and saves results to disk
         """
-        self._tree.by_path(path).inventory[key] = value
+        self.collect()
+        node = self._tree.by_path(path)
+        node.inventory[key] = value
+        self._touch(node)
         self._flush()
 
     def delete(self, path, key):
         """
         Deletes keys/value pair from the inventory and saves results to disk
         """
+        self.collect()
         try:
-            deleted = self._tree.by_path(path).inventory.pop(key)
+            node = self._tree.by_path(path)
+            deleted = node.inventory.pop(key)
         except KeyError:  # node or key cannot be found
             return
+        self._touch(node)
         self._flush()
         return deleted
 
+    def apply(self, operations):
+        """
+        Applies a batch of set/delete operations and saves the results to disk once.
+
+        Every operation is checked before the inventory is modified, so an invalid
+        one leaves both the inventory and the files untouched.
+        """
+        self.collect()
+        checked = [self._check_operation(i) for i in operations]
+        for op, node, key, value in checked:
+            if node is None:  # delete from a path that doesn't exist
+                continue
+            if op == 'set':
+                node.inventory[key] = value
+            elif key in node.inventory:
+                del node.inventory[key]
+            else:  # nothing to delete
+                continue
+            self._touch(node)
+        self._flush()
+        return len(checked)
+
+    def _check_operation(self, operation):
+        if not isinstance(operation, dict) or operation.get('op') not in ('set', 'delete') \
+                or 'path' not in operation or 'key' not in operation \
+                or (operation['op'] == 'set' and 'value' not in operation):
+            raise ValueError("invalid operation: {}".format(operation))
+        op = operation['op']
+        try:
+            node = self._tree.by_path(operation['path'])
+        except KeyError:
+            if op == 'set':
+                raise ValueError("path not in the infra tree: {}".format(operation['path']))
+            node = None
+        return op, node, operation['key'], operation.get('value')
+
+    def _touch(self, node):
+        """
+        Marks node as modified in place
+        """
+        node.invalidate()
+        self._dirty[node.path] = node
+        self._indexes.clear()
+        self._modified = True
+
     def _flush(self):
         """
-        Saves current inventory to disk
+        Saves modified nodes of the inventory to disk. Files of untouched nodes are
+        left alone, the file of a node whose inventory became empty is removed.
         """
-        dir_rm(self.inventory_dir)
-        for node in (i for i in self._tree.all() if i.inventory):
+        for node in self._dirty.values():
             # XXX: this infra/ bugs me
             dst_dir = join(self.inventory_dir, node.path.lstrip('/'))
-            mkdir_p(dst_dir)
-            with open(join(dst_dir, self.config_filename), 'w+') as f:
-                yaml.safe_dump(node.inventory, f, default_flow_style=False)
+            dst = join(dst_dir, self.config_filename)
+            if node.inventory:
+                mkdir_p(dst_dir)
+                atomic_write(dst, yaml_dump(node.inventory))
+            elif os.path.isfile(dst):
+                os.unlink(dst)
+                prune_empty(dst_dir, self.inventory_dir)
+        self._dirty.clear()
 
     def search_key(self, pattern):
         rgx = re.compile(pattern)
-        return [(n.path, n.inventory) for n in self._tree.all() if rgx.search(n.path) and n.inventory]
+        return [(p, self._tree.by_path(p).inventory)
+                for p in self._search_index('keys').search(rgx)]
 
     def search_value(self, pattern):
         rgx = re.compile(pattern)
+        return [(p, {k: self._tree.by_path(p).inventory[k]})
+                for p, k in self._search_index('values').search(rgx)]
+
+    def _search_index(self, kind):
+        """
+        Returns the search index of paths ('keys') or of keys and values ('values').
+
+        With a cache dir the index is stored there and reused by later runs as long
+        as the inventory files and the nodes they belong to are the same.
+        """
+        self.collect()
+        if kind in self._indexes:
+            return self._indexes[kind]
+        index_path = join(self.cache_dir, 'search-' + kind) if self._cache.path else None
+        signature = self._signature() if index_path else None
+        index = None
+        if index_path is not None:
+            try:
+                with open(index_path, 'rb') as f:
+                    stored_signature, index = pickle.load(f)
+                if stored_signature != signature:
+                    index = None
+            except Exception:  # no index yet, or unreadable - build it
+                index = None
+        if index is None:
+            index = self._build_index(kind)
+            # once modified, the signature no longer describes the inventory
+            if index_path is not None and not self._modified:
+                write_cache(index_path, pickle.dumps((signature, index), 2))
+        self._indexes[kind] = index
+        return index
 
-        def lookup():
-            for n in self._tree.all():
-                for k, v in n.inventory.items():
-                    if rgx.search(k) or rgx.search(str(v)):  # v might be int or float
-                        yield n.path, {k: v}
+    def _build_index(self, kind):
+        if kind == 'keys':
+            paths = [n.path for n in self._tree.all() if n.has_inventory]
+            return SearchIndex(paths, [(p,) for p in paths])
+        items, fields = [], []
+        for n in self._tree.all():
+            if not n.has_inventory:
+                continue
+            for k, v in n.inventory.items():
+                items.append((n.path, k))
+                fields.append((k, str(v)))  # v might be int or float
+        return SearchIndex(items, fields)
 
-        return list(lookup())
+    def _signature(self):
+        return sorted((path, self._cache.stamp(f)) for path, f in self._sources.items())
@@ -1,34 +1,223 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
 import operator
+import fnmatch
+import multiprocessing
+from array import array
+from bisect import bisect_left
 from functools import reduce
 from os.path import join
-from collections import MutableMapping
-import yaml
+from collections import deque, Mapping, MutableMapping
 
+from . import user_cache_dir
 from . import inventory
-from . import view
-from . import dir_rm
+from . import search
+from . import output
+
+
+class ChainedDict(Mapping):
+    """
+    Read-only view over a list of dicts, looked up in order (like py3's ChainMap).
+
+    Lets a node share the merged inventory of its parent instead of copying it.
+    """
+
+    def __init__(self, *maps):
+        self.maps = list(maps)
+
+    def new_child(self, layer):
+        return ChainedDict(layer, *self.maps)
+
+    def to_dict(self):
+        flat = {}
+        for m in reversed(self.maps):
+            flat.update(m)
+        return flat
+
+    def __getitem__(self, key):
+        for m in self.maps:
+            if key in m:
+                return m[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(key in m for m in self.maps)
+
+    def __iter__(self):
+        seen = set()
+        for m in self.maps:
+            for key in m:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.maps))
+
+    def __repr__(self):
+        return "ChainedDict({})".format(self.to_dict())
+
+
+try:
+    _intern = sys.intern
+except AttributeError:  # python 2
+    _intern = intern  # noqa: F821
+
+_glob_special = re.compile(r'[*?[]')
+
+# shared by every node without children (most of them are leaves), see __setitem__
+_NO_CHILDREN = {}
+
+
+def intern_name(value):
+    """
+    Interns names and levels, repeated on every node of the same kind
+    """
+    try:
+        return _intern(value)
+    except TypeError:  # unicode on python 2, or not a string
+        return value
+
+
+class TreeIndex(object):
+    """
+    Flat, array-backed index of a tree, built without recursion.
+
+    Nodes are stored in depth-first preorder, so the subtree of a node is the
+    contiguous slice from its position to ends[position]. parents holds the
+    position of the parent of every node (-1 for the root) and breadth the
+    positions in breadth-first order.
+
+    positions maps the path of every node to its position and paths lists them
+    sorted, for prefix and glob queries.
+    """
+    __slots__ = ('nodes', 'parents', 'ends', 'breadth', 'leaves', 'positions', 'paths')
+
+    def __init__(self, root):
+        self.nodes = []
+        self.parents = array('l')
+        pending = [(root, -1)]
+        while pending:
+            node, parent = pending.pop()
+            node._position = len(self.nodes)
+            if node._path is None and parent >= 0:  # without walking up from every node
+                node._path = join(self.nodes[parent].path, str(node))
+            self.nodes.append(node)
+            self.parents.append(parent)
+            pending.extend((i, node._position) for i in reversed(list(node.children.values())))
+        count = len(self.nodes)
+        self.ends = array('l', range(1, count + 1))
+        for i in range(count - 1, 0, -1):
+            parent = self.parents[i]
+            if self.ends[i] > self.ends[parent]:
+                self.ends[parent] = self.ends[i]
+        # breadth-first order, without the quadratic list.pop(0)
+        self.breadth = array('l')
+        pending = deque([root])
+        while pending:
+            node = pending.popleft()
+            self.breadth.append(node._position)
+            pending.extend(node.children.values())
+        self.leaves = [self.nodes[i] for i in self.breadth if self.ends[i] == i + 1]
+        self.positions = dict((node.path, i) for i, node in enumerate(self.nodes))
+        self.paths = sorted(self.positions)
+
+    def subtree(self, node):
+        return self.nodes[node._position:self.ends[node._position]]
+
+    def match(self, pattern):
+        """
+        Returns the nodes whose path matches the glob pattern, only the paths
+        starting with its literal prefix are looked at. As in a shell, wildcards
+        match within a path segment: /prod/* matches /prod/main, not /prod/main/api.
+        """
+        prefix = _glob_special.split(pattern, 1)[0]
+        segments = pattern.split('/')
+        found = []
+        for i in range(bisect_left(self.paths, prefix), len(self.paths)):
+            path = self.paths[i]
+            if not path.startswith(prefix):
+                break
+            parts = path.split('/')
+            if len(parts) == len(segments) and \
+                    all(fnmatch.fnmatchcase(p, s) for p, s in zip(parts, segments)):
+                found.append(self.nodes[self.positions[path]])
+        return found
 
 
 class Node(MutableMapping):
     path_delimiter = "/"
+    # 100k+ nodes trees are common, keep them small. Python 3 only: the python 2
+    # MutableMapping and its bases don't declare __slots__, so nodes get a __dict__
+    __slots__ = ('name', 'level', 'parent', 'root', 'children', '_inventory',
+                 '_path', '_flatten', '_as_dict', '_position', '_index')
 
     def __init__(self, name, level, parent, root=None):
-        self.name = name
-        self.level = level
+        self.name = intern_name(name)
+        self.level = intern_name(level)
         self.parent = parent
-        self.root = root or self
-        self.children = dict()
-        self.inventory = dict()
+        # not `root or self`: a root without children yet is an empty mapping
+        self.root = root if root is not None else self
+        self.children = _NO_CHILDREN
+        self._inventory = None
+        # computed on first access, see invalidate()
+        self._path = None
+        self._flatten = None
+        self._as_dict = None
+        # see TreeIndex, only the root keeps one
+        self._position = None
+        self._index = None
+
+    @property
+    def inventory(self):
+        # nodes without an inventory file don't get a dict until it's needed
+        if self._inventory is None:
+            self._inventory = {}
+        return self._inventory
+
+    @inventory.setter
+    def inventory(self, value):
+        self._inventory = value
+        self.invalidate()
+
+    @property
+    def has_inventory(self):
+        return bool(self._inventory)
+
+    @property
+    def index(self):
+        """
+        The TreeIndex of the whole tree, built on first access
+        """
+        root = self.root
+        if root._index is None:
+            root._index = TreeIndex(root)
+        return root._index
+
+    def invalidate(self):
+        """
+        Drops cached inventories of the node and its subtree - call it after
+        the inventory of the node has been modified in place
+        """
+        for node in self.subtree():
+            node._flatten = node._as_dict = None
+
+    def subtree(self):
+        """
+        Returns the node and all its descendants
+        """
+        return self.index.subtree(self)
 
     def all(self):
-        # XXX: my spider senses are saying this could be implemented better
-        yield self.root
-        pending = [self.root, ]
-        while pending:
-            for child in pending.pop(0):
-                yield child
-                if child.has_children:
-                    pending.append(child)
+        """
+        Returns every node of the tree, breadth first
+        """
+        index = self.index
+        return [index.nodes[i] for i in index.breadth]
 
     def up(self):
         node = self
@@ -38,11 +227,17 @@ class Node(MutableMapping):
 
     @property
     def leaves(self):
-        return [i for i in self.all() if not i.has_children]
+        """
+        The leaves of the whole tree, breadth first (don't modify the list)
+        """
+        return self.index.leaves
 
     @property
     def path(self):
-        return reduce(join, reversed([str(i) for i in self.up()]))
+        # nodes are never moved or renamed so the path doesn't need invalidation
+        if self._path is None:
+            self._path = reduce(join, reversed([str(i) for i in self.up()]))
+        return self._path
 
     @property
     def has_children(self):
@@ -54,22 +249,31 @@ class Node(MutableMapping):
         return path.split(self.path_delimiter)[1:]
 
     def by_path(self, path):
+        index = self.index
+        if path in index.positions:
+            return index.nodes[index.positions[path]]
+        # not the path of a node as is (e.g. a trailing slash), or no node at all
         return reduce(operator.getitem, self.path_to_list(path), self.root)
 
     @property
     def flatten(self):
-        def merge_dicts(x, y):
-            '''
-            if I only had python3.5 {**x, **y} :<
-            '''
-            c = y.inventory.copy()
-            s_key = "{}__source"
-            # tracking the source. appends a path to a __source key.
-            list(map(lambda i: x.setdefault(s_key.format(i), []).append(y.path), c))
-            c.update(x)
-            return c
-
-        return reduce(merge_dicts, self.up(), {})
+        if self._flatten is None:
+            self._flatten = self._merge_inventories()
+        return self._flatten
+
+    def _merge_inventories(self):
+        """
+        Layers the node's own inventory on top of the (cached) one of its parent
+        """
+        parent = self.parent.flatten if self.parent is not None else ChainedDict()
+        if not self._inventory:
+            return parent
+        layer = dict(self._inventory)
+        s_key = "{}__source"
+        # tracking the source. prepends the path to the parent's __source key.
+        for i in self._inventory:
+            layer[s_key.format(i)] = [self.path] + parent.get(s_key.format(i), [])
+        return parent.new_child(layer)
 
     def __repr__(self):
         return "Node <{}>: {}".format(id(self), self.name)
@@ -81,7 +285,10 @@ class Node(MutableMapping):
         return self.children[key]
 
     def __setitem__(self, key, value):
+        if self.children is _NO_CHILDREN:
+            self.children = {}
         self.children[key] = value
+        self.root._index = None
 
     def __iter__(self):
         return iter(self.children.values())
@@ -94,17 +301,59 @@ class Node(MutableMapping):
 
     @property
     def as_dict(self):
-        stages = {i.level: i for i in self.up()}
-        stages.update(self.flatten)
-        return stages
+        if self._as_dict is None:
+            # inventory keys take precedence over the stage names
+            stages = {i.level: i for i in self.up()}
+            self._as_dict = ChainedDict(*(self.flatten.maps + [stages]))
+        return self._as_dict
+
+
+def _fork_context():
+    """
+    Returns the multiprocessing context forking workers, None where processes
+    can't be forked (workers get the ConfGen by fork, it can't be pickled)
+    """
+    if not hasattr(multiprocessing, 'get_context'):  # python 2 forks, except on windows
+        return None if sys.platform == 'win32' else multiprocessing
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:  # e.g. windows
+        return None
+
+
+# ConfGen of a build worker process, see ConfGen.render_leaves
+_worker_confgen = None
+_worker_previous = None
+
+
+def _init_worker(confgen, previous):
+    global _worker_confgen, _worker_previous
+    _worker_confgen = confgen
+    _worker_previous = previous
+    if confgen.timings is not None:  # recorded by the parent before forking
+        confgen.timings.drain()
+
+
+def _render_leaves(paths):
+    confgen = _worker_confgen
+    rendered = [confgen.render_leaf(confgen.root.by_path(i), _worker_previous) for i in paths]
+    # what the worker recorded goes back with the results
+    return rendered, confgen.timings.drain() if confgen.timings is not None else None
 
 
 class ConfGen(object):
     build_dir = 'build'
+    store_dir = '.confgen-store'
 
-    def __init__(self, home, config):
+    def __init__(self, home, config, cache=False, lazy=False):
         self.home = home
-        self.config = yaml.load(config)
+        self.config_path = getattr(config, 'name', None)
+        # persistent caches (parsed inventory, compiled templates), see cache_location
+        self.cache_home = self.cache_location(home) if cache else None
+        self.config = inventory.yaml_load(config)
+        # part of every output fingerprint, the tree and hierarchy shape the context
+        self.config_hash = hashlib.sha1(json.dumps(
+            self.config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
         assert 'hierarchy' in self.config, "hierarchy list is required"
         assert 'infra' in self.config, "infra tree is required"
         if 'service' not in self.config:
@@ -112,8 +361,43 @@ class ConfGen(object):
         else:
             self.single_service = False
         self.root = self.build_tree(self.config['infra'])
-        self.inventory = inventory.Inventory(self.root, home)
-        self.renderer = view.Renderer(home)
+        # lazily, inventory files are read when (and as far as) they are needed
+        self.inventory = inventory.Inventory(self.root, home, self.cache_home, lazy=lazy)
+        self._renderer = None
+        # see timings.Timings.instrument
+        self.timings = None
+
+    @property
+    def renderer(self):
+        # jinja2 is only imported by commands rendering templates
+        if self._renderer is None:
+            from . import view
+            self._renderer = view.Renderer(self.home, self._cache_path('templates'))
+        return self._renderer
+
+    def reload(self):
+        """
+        Returns a new ConfGen reading confgen.yaml, inventory and templates again
+        """
+        with open(self.config_path) as config:
+            return ConfGen(self.home, config, cache=self.cache_home is not None)
+
+    @staticmethod
+    def cache_location(home):
+        """
+        Returns the cache dir of a config home. It is kept in the user's cache dir,
+        out of the config repo: its files are unpickled and run as code, so they
+        must never come from a commit.
+        """
+        path = os.path.realpath(home)
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        return join(user_cache_dir('confgen'), hashlib.sha1(path).hexdigest()[:16])
+
+    def _cache_path(self, name):
+        if self.cache_home is None:
+            return None
+        return join(self.cache_home, name)
 
     def build_tree(self, infra):
         root = Node('/', self.config['hierarchy'][0], None, None)
@@ -130,28 +414,207 @@ class ConfGen(object):
                     add_node(infra_sub[k], k, level + 1, node)
         for k in infra:
             add_node(infra[k], k, 1, root)
+        # the flat index of the tree, with the path lookups
+        root.index
         return root
 
-    def build(self):
-        # try to render templates
-        rendered = [(s, self.renderer.service(s, self.single_service))
-                    for s in self.root.leaves]
-        land_dir = join(self.home, self.build_dir)
-        # remove old tree
-        dir_rm(land_dir)
-        # flush the files
-        for node, rendered_tempaltes in rendered:
-            dst_dir = join(land_dir, node.path.lstrip('/'))
-            # create dirs if they don't exist
-            inventory.mkdir_p(dst_dir)
-            for filename, rendered_config in rendered_tempaltes.items():
-                with open(join(dst_dir, filename), 'w+') as f:
-                    f.write(rendered_config)
+    def render_leaf(self, leaf, previous=None, templates=None):
+        """
+        Renders the templates of a leaf (all of them unless a list of filenames is
+        given), returns {filename: (content, manifest entry)}.
+
+        previous are the manifest entries of the last build: outputs whose fingerprint
+        (templates and inventory keys used) is the same and whose file is unchanged
+        since (see output.unchanged) are not rendered again, their content is None
+        and the entry the recorded one.
+        """
+        dst_dir = leaf.path.lstrip('/')
+        rendered = {}
+        for filename, template in self.renderer.templates(leaf, self.single_service):
+            if templates is not None and filename not in templates:
+                continue
+            entry = self.renderer.fingerprint(template, leaf, self.config_hash)
+            recorded = (previous or {}).get(join(dst_dir, filename))
+            if entry is not None and recorded is not None and \
+                    recorded.get('fingerprint') == entry['fingerprint'] and \
+                    output.unchanged(join(self.home, self.build_dir, dst_dir, filename),
+                                     recorded):
+                rendered[filename] = (None, recorded)
+            elif entry is not None:
+                # the same for every leaf with the same context
+                rendered[filename] = (self.renderer.render_cached(
+                    template, leaf, entry['fingerprint']), entry)
+            else:
+                rendered[filename] = (self.renderer.render_template(template, leaf), entry)
+        return rendered
+
+    def render_leaves(self, leaves, jobs=1, previous=None):
+        """
+        Renders services for leaves (see render_leaf), in order. With jobs > 1 the
+        leaves are spread across a pool of worker processes.
+        """
+        return [r for leaf, r in self.iter_render(leaves, jobs, previous)]
+
+    def iter_render(self, leaves, jobs=1, previous=None, inflight=256):
+        """
+        Yields (leaf, rendered) as the leaves are rendered, in order. At most inflight
+        leaves are rendered ahead of the consumer, whatever the size of the tree.
+
+        Workers are forked whatever the default start method, where they can't be
+        the leaves are rendered in this process.
+        """
+        context = _fork_context() if jobs > 1 and len(leaves) > 1 else None
+        if context is None:
+            for leaf in leaves:
+                yield leaf, self.render_leaf(leaf, previous)
+            return
+        # workers get the whole ConfGen through fork, only paths and results are pickled
+        pool = context.Pool(jobs, _init_worker, (self, previous))
+        paths = [i.path for i in leaves]
+        # at most two chunks per worker are queued: results are collected in order so
+        # the first failing leaf is reported, as in serial, and an error only has to
+        # wait for the chunks in flight (Pool.terminate can deadlock on a busy queue)
+        window = max(1, min(jobs * 2, inflight))
+        chunksize = max(1, min(len(paths) // (jobs * 4) + 1, inflight // window))
+        pending = deque()
+        done = 0
+        try:
+            for i in range(0, len(paths), chunksize):
+                pending.append(pool.apply_async(_render_leaves, (paths[i:i + chunksize],)))
+                if len(pending) >= window:
+                    for rendered in self._collect_rendered(pending.popleft()):
+                        yield leaves[done], rendered
+                        done += 1
+            while pending:
+                for rendered in self._collect_rendered(pending.popleft()):
+                    yield leaves[done], rendered
+                    done += 1
+        finally:
+            pool.close()
+            pool.join()
+
+    def _collect_rendered(self, result):
+        rendered, records = result.get()
+        if records is not None:
+            self.timings.merge(records)
+        return rendered
+
+    def open_writer(self, scope=None, archive=None, archive_format='tar', store=False,
+                    threads=0, durable=False):
+        """
+        Returns the writer of a build: into archive if given, else the build dir
+        (see output.DirectoryWriter), hardlinking outputs to the content-addressed
+        store of the home with store
+        """
+        if archive is not None:
+            return output.ArchiveWriter(archive, archive_format)
+        return output.DirectoryWriter(join(self.home, self.build_dir), scope,
+                                      join(self.home, self.store_dir) if store else None,
+                                      threads, durable)
+
+    def resolve_inventories(self, nodes=None):
+        """
+        Computes the effective inventory of every node (or of the given ones and
+        their ancestors) in a single top-down pass, each node extending the already
+        merged inventory of its parent
+        """
+        self.inventory.collect(nodes)
+        for node in self.root.all() if nodes is None else nodes:
+            node.as_dict
+
+    def match_leaves(self, patterns):
+        """
+        Returns the leaves below any of the paths, which may be globs
+        (e.g. /prod/main, /*/qa*), in tree order
+        """
+        index = self.root.index
+        selected = set()
+        for pattern in patterns:
+            for node in index.match('/' + pattern.strip('/')):
+                selected.update(i._position for i in index.subtree(node))
+        return [leaf for leaf in index.leaves if leaf._position in selected]
+
+    def build(self, jobs=1, paths=None, inflight=256, archive=None, archive_format='tar',
+              store=False, write_threads=0, durable=False):
+        """
+        Renders all leaves, or those below paths (see match_leaves), into the build
+        dir, returns the number of files written.
+
+        Outputs are written as soon as their leaf is rendered, with at most inflight
+        leaves rendered ahead of writing. On a render error the outputs written so
+        far are kept and recorded, stale ones are only removed by a complete build.
+
+        With an archive (a binary file object) the outputs are written into it
+        instead (see output.ArchiveWriter), sorted by path. With store, identical
+        outputs are hardlinks to a single copy. write_threads write the files while
+        rendering goes on, durable writes are fsynced (see output.DirectoryWriter).
+        """
+        if paths is None:
+            leaves, scope = self.root.leaves, None
+        else:
+            leaves = self.match_leaves(paths)
+            if not leaves:
+                raise ValueError("no leaves match {}".format(', '.join(paths)))
+            scope = [i.path.lstrip('/') for i in leaves]
+        # merge the inventories and compile the templates before forking so
+        # workers share them, templates changed since the last build are seen
+        self.resolve_inventories(None if paths is None else leaves)
+        self.renderer.reset()
+        self.renderer.prepare()
+        writer = self.open_writer(scope, archive, archive_format, store, write_threads, durable)
+        if archive is not None:
+            leaves = sorted(leaves, key=lambda i: i.path_to_list(i.path))
+            previous = None
+        else:
+            # only changed files are written, stale ones are removed on close
+            previous = writer.manifest.entries
+        # try to render templates, skipping those whose dependencies didn't change
+        try:
+            for node, rendered_tempaltes in self.iter_render(leaves, jobs, previous, inflight):
+                dst_dir = node.path.lstrip('/')
+                for filename, (rendered_config, entry) in sorted(rendered_tempaltes.items()):
+                    if rendered_config is None:
+                        writer.keep(join(dst_dir, filename), entry)
+                    else:
+                        writer.write(join(dst_dir, filename), rendered_config, entry)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        return writer.written
+
+    def render(self, path, filename):
+        """
+        Renders the template filename for the leaf at path, reading only the inventory
+        files of the leaf and its ancestors and compiling only that template
+        """
+        try:
+            leaf = self.root.by_path(path)
+        except KeyError:
+            raise KeyError("no node {}".format(path))
+        if leaf.has_children:
+            raise KeyError("{} is not a leaf".format(path))
+        try:
+            templates = dict(self.renderer.templates(leaf, self.single_service))
+        except OSError:  # the service has no templates dir
+            raise KeyError("no templates for {}".format(leaf.name))
+        if filename not in templates:
+            raise KeyError("no template {} for {}".format(filename, path))
+        self.inventory.collect([leaf])
+        return self.renderer.render_template(templates[filename], leaf)
+
+    def warm_cache(self):
+        return self.renderer.warm()
+
+    def clear_cache(self):
+        # regardless of whether caching is enabled for this run
+        shutil.rmtree(self.cache_location(self.home), ignore_errors=True)
 
     def entire_inventory(self):
+        self.inventory.collect()
         renderable = ((i.path, i.inventory)
                       for i in self.inventory._tree.all())
-        return self.renderer.render_search_result(renderable)
+        return search.render_search_result(renderable)
 
     def set(self, path, key, value):
         self.inventory.set(path, key, value)
@@ -159,10 +622,13 @@ class ConfGen(object):
     def delete(self, path, key):
         self.inventory.delete(path, key)
 
+    def apply(self, operations):
+        return self.inventory.apply(operations)
+
     def search_key(self, pattern):
         result = self.inventory.search_key(pattern)
-        return self.renderer.render_search_result(result)
+        return search.render_search_result(result)
 
     def search_value(self, pattern):
         result = self.inventory.search_value(pattern)
-        return self.renderer.render_search_result(result)
+        return search.render_search_result(result)
@@ -0,0 +1,459 @@
+import io
+import os
+import errno
+import gzip
+import json
+import stat
+import hashlib
+import tarfile
+import zipfile
+import threading
+from os.path import join, dirname, isfile, relpath
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from . import atomic_write, mkdir_p, prune_empty, temp_path
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_stamp(st):
+    """
+    Returns what tells versions of a file apart besides its content, from its stat:
+    the mtime (in nanoseconds) and inode, recorded in the manifest
+    """
+    return {'mtime_ns': getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)), 'inode': st.st_ino}
+
+
+def unchanged(path, entry):
+    """
+    Returns whether the file at path is still the one its manifest entry was recorded
+    for (same size, mtime and inode), so the recorded hash describes its content
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_size == entry.get('size') and \
+        all(entry.get(k) == v for k, v in file_stamp(st).items())
+
+
+class Manifest(object):
+    """
+    Records every file produced by the last build together with its content hash,
+    size, mtime and inode.
+
+    It lives inside the build directory so it always describes what is on disk.
+    """
+    filename = '.confgen-manifest'
+
+    def __init__(self, land_dir):
+        self.path = join(land_dir, self.filename)
+        self.entries = {}
+        self.exists = False
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)['files']
+            self.exists = True
+        except (IOError, OSError, ValueError, KeyError):
+            # no manifest (first build) or garbage - treat the build dir as unknown
+            self.entries = {}
+        return self
+
+    def save(self, entries, fsync=False):
+        self.entries = entries
+        data = json.dumps({'files': entries}, indent=1, sort_keys=True)
+        atomic_write(self.path, data.encode('utf-8'), fsync)
+
+
+def _linked(path):
+    """
+    Returns whether path is a hardlink, or a read-only output that was one (its blob
+    pruned from the store): a file to replace rather than write to
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_nlink > 1 or not st.st_mode & stat.S_IWUSR
+
+
+class DirectoryWriter(object):
+    """
+    Writes rendered files into the build directory incrementally.
+
+    Only files whose content has changed are (re)written, so unchanged files keep
+    their mtimes. Files produced by the previous build but not by this one are
+    removed on close.
+
+    A partial build passes the paths (files or directories, relative to the build
+    dir) it is responsible for as scope, outputs outside of it are left alone.
+
+    With a store (a directory on the same filesystem) every distinct content is
+    written there once, named by its hash, and outputs are read-only hardlinks to
+    it. Where hardlinks aren't possible the content is written as usual.
+
+    With threads, files are written by that many threads while the caller goes on
+    (directories are still created by the caller, once each). Durable writes fsync
+    every file and, on close, every directory written to once.
+    """
+
+    blob_mode = 0o444
+
+    def __init__(self, land_dir, scope=None, store=None, threads=0, durable=False):
+        self.land_dir = land_dir
+        self.store = store
+        self.durable = durable
+        self.written = 0
+        # directories known to exist, and those files were written to
+        self._dirs = set()
+        self._written_dirs = set()
+        self._lock = threading.Lock()
+        self._errors = []
+        self._queue = None
+        self._threads = []
+        self._thread_count = threads
+        self._linkable = True
+        if threads > 0:
+            # bounded, so rendering can't get too far ahead of writing
+            self._queue = queue.Queue(threads * 16)
+        self.manifest = Manifest(land_dir).load()
+        self.scope = None
+        if scope is not None:
+            self.scope = set(i.strip(os.sep) for i in scope)
+            if '' in self.scope:  # the whole build dir
+                self.scope = None
+        self.produced = {}
+        # outputs of previous builds this one doesn't touch
+        self.kept = {p: e for p, e in self.manifest.entries.items() if not self.in_scope(p)}
+
+    def in_scope(self, path):
+        if self.scope is None:
+            return True
+        parts = path.split(os.sep)
+        return any(os.sep.join(parts[:i]) in self.scope for i in range(1, len(parts) + 1))
+
+    def write(self, path, content, meta=None):
+        """
+        Writes content to path (relative to the build dir) unless it is already there.
+        meta is recorded in the manifest along with the hash and size of the content.
+
+        Returns whether the file was written, None if it was handed to the threads
+        (written counts the files written either way).
+        """
+        data = content.encode('utf-8')
+        digest = content_hash(data)
+        entry = dict(meta or {})
+        entry.update(sha1=digest, size=len(data))
+        dst = join(self.land_dir, path)
+        directory = dirname(dst)
+        if directory not in self._dirs:
+            mkdir_p(directory)
+            self._dirs.add(directory)
+        return self._submit((path, entry, dst, data))
+
+    def _submit(self, job):
+        if self._queue is None:
+            return self._write(*job)
+        if self._errors:  # stop early, close() raises it
+            return None
+        if not self._threads:
+            self._start()
+        self._queue.put(job)
+
+    def _start(self):
+        # on the first write rather than on open: a build forks its render workers
+        # first, and forking a process running threads can deadlock the children
+        for _ in range(self._thread_count):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _write(self, path, entry, dst, data):
+        # recorded once on disk, so an interrupted build records only what it wrote
+        digest = entry['sha1']
+        if self._up_to_date(dst, data, digest, self.manifest.entries.get(path)):
+            if self._needs_link(dst) and self._link(dst, data, digest):
+                with self._lock:  # the same content, now shared
+                    self._written_dirs.add(dirname(dst))
+            entry.update(file_stamp(os.stat(dst)))
+            self.produced[path] = entry
+            return False
+        if self.store is None or not self._link(dst, data, digest):
+            if _linked(dst):  # don't change the content of the other links
+                os.unlink(dst)
+            with open(dst, 'wb') as f:
+                f.write(data)
+                if self.durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+        entry.update(file_stamp(os.stat(dst)))
+        with self._lock:
+            self.produced[path] = entry
+            self.written += 1
+            self._written_dirs.add(dirname(dst))
+        return True
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                if not self._errors:
+                    self._write(*job)
+            except Exception as e:
+                self._errors.append(e)
+
+    def _finish(self):
+        """
+        Waits for the threads to write what they were given, raises the first
+        error they hit
+        """
+        if self._threads:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+        if self._errors:
+            raise self._errors[0]
+
+    def _link(self, dst, data, digest):
+        """
+        Hardlinks dst to the blob of data in the store, returns False if it can't
+        """
+        blob = join(self.store, digest[:2], digest[2:])
+        tmp = temp_path(dst)
+        try:
+            try:
+                st = os.stat(blob)
+            except OSError:
+                mkdir_p(dirname(blob))
+                self._create_blob(blob, data)
+            else:
+                if st.st_size != len(data):  # changed through one of its links
+                    atomic_write(blob, data, self.durable, mode=self.blob_mode)
+                elif st.st_mode & 0o222:  # stored by an older version
+                    os.chmod(blob, self.blob_mode)
+            os.link(blob, tmp)
+            os.rename(tmp, dst)
+        except (OSError, AttributeError):  # e.g. another filesystem, no hardlinks there
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            self._linkable = False
+            return False
+        return True
+
+    def _create_blob(self, blob, data):
+        # read-only, so outputs can't be edited in place, changing the others. Linked
+        # rather than renamed into place: of the threads storing the same new content
+        # the first one creates the blob, the others link to it
+        tmp = temp_path(blob)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                if self.durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.chmod(tmp, self.blob_mode)
+            try:
+                os.link(tmp, blob)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        finally:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+
+    def _needs_link(self, dst):
+        # with a store, outputs written before it was used (or without it) are linked
+        # to it too, unless hardlinks turned out not to be possible
+        if self.store is None or not self._linkable:
+            return False
+        try:
+            return os.stat(dst).st_nlink == 1
+        except OSError:
+            return False
+
+    def keep(self, path, entry):
+        """
+        Records path as produced by this build without touching the file, for outputs
+        known to be unchanged (entry is the one recorded by the previous build). With
+        a store, an output not linked to it yet is.
+        """
+        dst = join(self.land_dir, path)
+        if self._needs_link(dst):
+            with open(dst, 'rb') as f:
+                self._submit((path, entry, dst, f.read()))
+            return
+        self.produced[path] = entry
+
+    def _up_to_date(self, dst, data, digest, recorded):
+        if recorded is not None and unchanged(dst, recorded):
+            return recorded['sha1'] == digest
+        # no manifest entry (e.g. first incremental build), or the file was replaced
+        # since (e.g. build/ checked out from git) - compare with the file
+        try:
+            if os.stat(dst).st_size != len(data):
+                return False
+            with open(dst, 'rb') as f:
+                return content_hash(f.read()) == digest
+        except (IOError, OSError):
+            return False
+
+    def stale(self):
+        """
+        Lists files (relative to the build dir) that were not produced by this build
+        """
+        if self.manifest.exists:
+            previous = self.manifest.entries
+        else:
+            previous = list(self._walk())
+        return sorted(i for i in previous if i not in self.produced and self.in_scope(i))
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.land_dir):
+            for f in files:
+                path = relpath(join(root, f), self.land_dir)
+                if path != Manifest.filename:
+                    yield path
+
+    def close(self):
+        self._finish()
+        for path in self.stale():
+            dst = join(self.land_dir, path)
+            if isfile(dst):
+                os.unlink(dst)
+            prune_empty(dirname(dst), self.land_dir)
+        mkdir_p(self.land_dir)
+        entries = dict(self.kept)
+        entries.update(self.produced)
+        self._sync_dirs()
+        self.manifest.save(entries, self.durable)
+        if self.store is not None:
+            self.prune_store()
+        self._sync_dirs([self.land_dir])
+
+    def _sync_dirs(self, dirs=None):
+        """
+        With durable writes, makes the entries of the directories written to durable
+        """
+        if not self.durable:
+            return
+        for path in sorted(self._written_dirs if dirs is None else dirs):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:  # removed as stale since
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:  # not supported, e.g. on windows
+                pass
+            finally:
+                os.close(fd)
+
+    def prune_store(self):
+        """
+        Removes the blobs of the store no output links to anymore
+        """
+        for root, dirs, files in os.walk(self.store):
+            for f in files:
+                blob = join(root, f)
+                if os.stat(blob).st_nlink == 1:
+                    os.unlink(blob)
+            if root != self.store and not os.listdir(root):
+                os.rmdir(root)
+
+    def abort(self):
+        """
+        Records what was written by an interrupted build, leaving every other output
+        (and the manifest entry describing it) in place
+        """
+        try:
+            self._finish()
+        except Exception:  # the error interrupting the build is the one to report
+            pass
+        mkdir_p(self.land_dir)
+        entries = dict(self.manifest.entries)
+        entries.update(self.produced)
+        self.manifest.save(entries)
+
+
+class ArchiveWriter(object):
+    """
+    Streams rendered files into a tar, gzipped tar or zip archive.
+
+    Archives are deterministic: entries have fixed mtimes, owners and modes (the
+    caller writes them in a stable order), so the same outputs always give the
+    same bytes. The file object is left open.
+    """
+    formats = ('tar', 'tar.gz', 'zip')
+    mode = 0o644
+    # zip can't store times before 1980
+    zip_date_time = (1980, 1, 1, 0, 0, 0)
+
+    def __init__(self, fileobj, format='tar'):
+        if format not in self.formats:
+            raise ValueError("unknown archive format: {}".format(format))
+        self.fileobj = fileobj
+        self.format = format
+        self.written = 0
+        self._gzip = None
+        if format == 'zip':
+            self._archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+            return
+        if format == 'tar.gz':
+            # no name nor timestamp in the gzip header
+            self._gzip = fileobj = gzip.GzipFile(filename='', mode='wb', fileobj=fileobj, mtime=0)
+        self._archive = tarfile.open(fileobj=fileobj, mode='w', format=tarfile.GNU_FORMAT)
+
+    @classmethod
+    def format_of(cls, filename):
+        """
+        Guesses the format from the extension of filename, '-' (stdout) is a tar
+        """
+        if filename == '-' or filename.endswith('.tar'):
+            return 'tar'
+        if filename.endswith(('.tar.gz', '.tgz')):
+            return 'tar.gz'
+        if filename.endswith('.zip'):
+            return 'zip'
+        raise ValueError("unknown archive format: {}".format(filename))
+
+    def write(self, path, content, meta=None):
+        """
+        Adds content as path, always returns True (meta is ignored)
+        """
+        data = content.encode('utf-8')
+        path = path.replace(os.sep, '/')
+        if self.format == 'zip':
+            info = zipfile.ZipInfo(path, self.zip_date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = self.mode << 16
+            self._archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mode = self.mode
+            info.mtime = 0
+            self._archive.addfile(info, io.BytesIO(data))
+        self.written += 1
+        return True
+
+    def close(self):
+        self._archive.close()
+        if self._gzip is not None:
+            self._gzip.close()
+        self.fileobj.flush()
+
+    # an archive is only valid once complete, a partial one is closed all the same
+    abort = close
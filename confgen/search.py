@@ -0,0 +1,163 @@
+from collections import defaultdict
+
+
+def required_literals(pattern):
+    """
+    Returns substrings that any match of the regex pattern has to contain.
+
+    It is conservative: parts of the pattern it doesn't understand are skipped,
+    and an empty list means nothing is known about the matches.
+    """
+    if '|' in pattern or '(?' in pattern:  # alternatives or flags such as (?i)
+        return []
+    literals, current = [], []
+
+    def flush():
+        if current:
+            literals.append(''.join(current))
+            del current[:]
+
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if escaped and not escaped.isalnum():  # e.g. \. is a literal dot
+                current.append(escaped)
+                i += 2
+            else:  # \d, \w, \b, \x41, \N{...}, back references...
+                flush()
+                i = _skip_escape(pattern, i)
+            continue
+        if c in '*?{':  # the previous character is optional
+            if current:
+                current.pop()
+            flush()
+            if c == '{':
+                i = _skip(pattern, i, '{', '}')
+        elif c == '[':
+            flush()
+            i = _skip_class(pattern, i)
+        elif c == '(':
+            flush()
+            i = _skip(pattern, i, '(', ')')
+        elif c in '+.^$)':
+            flush()
+        else:
+            current.append(c)
+        i += 1
+    flush()
+    return literals
+
+
+def _skip_escape(pattern, i):
+    """
+    Returns the index following the escape with a letter or digit starting at i
+    """
+    escaped = pattern[i + 1:i + 2]
+    end = i + 2
+    if escaped == 'N' and pattern[end:end + 1] == '{':
+        return pattern.find('}', end) + 1 or len(pattern)
+    if escaped.isdigit():  # a back reference or an octal escape, 3 digits at most
+        digits, hexadecimal = 2, False
+    else:
+        digits, hexadecimal = {'x': 2, 'u': 4, 'U': 8}.get(escaped, 0), True
+    while digits and end < len(pattern) and \
+            pattern[end] in ('0123456789abcdefABCDEF' if hexadecimal else '0123456789'):
+        end += 1
+        digits -= 1
+    return end
+
+
+def _skip(pattern, i, opening, closing):
+    """
+    Returns the index of the closing character matching the opening one at i
+    """
+    depth = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            i = _skip_class(pattern, i)
+        elif c == opening:
+            depth += 1
+        elif c == closing:
+            depth -= 1
+            if not depth:
+                return i
+        i += 1
+    return i
+
+
+def _skip_class(pattern, i):
+    """
+    Returns the index of the ] closing the character class starting at i
+    """
+    i += 1
+    if pattern[i:i + 1] == '^':
+        i += 1
+    if pattern[i:i + 1] == ']':  # a leading ] is a literal
+        i += 1
+    while i < len(pattern) and pattern[i] != ']':
+        if pattern[i] == '\\':
+            i += 1
+        i += 1
+    return i
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex(object):
+    """
+    Trigram index over search items, each with a tuple of fields to match.
+
+    A regex is only tested against the items that contain every trigram of the
+    literals the regex requires, items are scanned only if it requires none.
+    """
+
+    def __init__(self, items, fields):
+        self.items = items
+        self.fields = fields
+        self.postings = defaultdict(set)
+        for n, item_fields in enumerate(fields):
+            for field in item_fields:
+                for t in trigrams(field):
+                    self.postings[t].add(n)
+        self.postings = dict(self.postings)
+
+    def candidates(self, pattern):
+        required = set()
+        for literal in required_literals(pattern):
+            required |= trigrams(literal)
+        if not required:
+            return range(len(self.items))
+        found = None
+        # the rarest trigrams first, so the intersection shrinks quickly
+        for t in sorted(required, key=lambda i: len(self.postings.get(i, ()))):
+            found = self.postings.get(t, set()) if found is None else found & self.postings.get(t, set())
+            if not found:
+                return []
+        return sorted(found)
+
+    def search(self, rgx):
+        """
+        Returns the items with a field matched by the compiled regex, in index order
+        """
+        return [self.items[n] for n in self.candidates(rgx.pattern)
+                if any(rgx.search(f) for f in self.fields[n])]
+
+
+def render_search_result(result):
+    """
+    Formats (path, inventory) pairs as a table
+    """
+    import tabulate  # only commands printing tables need it
+    table = []
+    for path, inventory in result:
+        for ikey, ivalue in inventory.items():
+            table.append((path, ikey, ivalue))
+
+    return tabulate.tabulate(table, ['path', 'key', 'value'], tablefmt='psql')
@@ -0,0 +1,122 @@
+import time
+import logging
+from collections import OrderedDict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import unquote, urlsplit
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib import unquote
+    from urlparse import urlsplit
+
+from .view import RenderError
+from .watch import Watcher, snapshot
+
+log = logging.getLogger(__name__)
+
+
+class ConfigServer(object):
+    """
+    Renders outputs on demand (GET /<leaf path>/<template>) from a ConfGen kept in
+    memory, keeping the most recent ones in an LRU cache.
+
+    Changes to the inventory, templates or confgen.yaml are polled for (at most
+    every interval seconds, when a request comes) and drop the cached outputs they
+    affect, see watch.Watcher.
+    """
+
+    def __init__(self, confgen, cache_size=1024, interval=0.5):
+        self.watcher = Watcher(confgen, interval)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.last_poll = time.time()
+        self._load()
+
+    @property
+    def confgen(self):
+        return self.watcher.confgen
+
+    def _load(self):
+        # everything is read and compiled once, requests only render
+        self.confgen.resolve_inventories()
+        self.confgen.renderer.prepare()
+
+    def refresh(self):
+        """
+        Drops the cached outputs affected by files changed since the last poll
+        """
+        if time.time() - self.last_poll < self.watcher.interval:
+            return
+        self.last_poll = time.time()
+        changed = self.watcher.poll()
+        if not changed:
+            return
+        if self.confgen.config_path in changed:
+            self.watcher.confgen = self.confgen.reload()
+            self.watcher.state = snapshot(self.watcher.watched())
+            self.cache.clear()
+            self._load()
+            return
+        for leaf_path, templates in self.watcher.affected(changed).items():
+            for key in [i for i in self.cache if i[0] == leaf_path]:
+                if templates is None or key[1] in templates:
+                    del self.cache[key]
+
+    def get(self, url):
+        """
+        Returns (HTTP status, body) for the url of an output
+        """
+        path = unquote(urlsplit(url).path).rstrip('/')
+        leaf_path, _, filename = path.rpartition('/')
+        key = (leaf_path, filename)
+        try:
+            self.refresh()
+        except Exception as e:  # e.g. broken yaml - serve what we have until it's fixed
+            log.error("while reloading: {}".format(e))
+        if key in self.cache:
+            self.cache[key] = self.cache.pop(key)
+            return 200, self.cache[key]
+        try:
+            leaf = self.confgen.root.by_path(leaf_path)
+        except KeyError:
+            return 404, b'no such node\n'
+        if leaf.has_children:
+            return 404, b'not a leaf\n'
+        try:
+            templates = dict(self.confgen.renderer.templates(leaf, self.confgen.single_service))
+        except OSError:  # the service has no templates dir
+            return 404, b'no templates for this service\n'
+        if filename not in templates:
+            return 404, b'no such template\n'
+        try:
+            rendered = self.confgen.renderer.render_template(templates[filename], leaf)
+        except RenderError as e:
+            return 500, u'{}\n'.format(e).encode('utf-8')
+        if len(self.cache) >= self.cache_size:
+            self.cache.popitem(last=False)
+        self.cache[key] = rendered.encode('utf-8')
+        return 200, self.cache[key]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status, body = self.server.app.get(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info(format, *args)
+
+
+def make_server(app, host='127.0.0.1', port=8642):
+    """
+    Returns an HTTPServer answering requests with app (a ConfigServer), one at a time
+    """
+    server = HTTPServer((host, port), RequestHandler)
+    server.app = app
+    return server
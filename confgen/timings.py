@@ -0,0 +1,157 @@
+import sys
+import time
+import json
+import functools
+
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def peak_memory(who='self'):
+    """
+    Returns the peak resident memory in bytes of this process ('self') or of its
+    finished children ('children'), None where it can't be known
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # kilobytes on linux, bytes on macos
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class Timings(object):
+    """
+    Records wall time, call counts and the peak memory reached by the phases of a
+    confgen run, and the time spent rendering every template and leaf.
+
+    Nothing is measured unless instrument() wraps the methods of a ConfGen, so
+    there is no cost when timings are off.
+    """
+
+    def __init__(self):
+        self.start = timer()
+        # name -> [seconds, calls, peak memory at the end]
+        self.phases = {}
+        self.order = []
+        # (kind, name) -> [seconds, calls], kind is 'template' or 'leaf'
+        self.renders = {}
+
+    def add(self, name, seconds, calls=1, memory=None):
+        if name not in self.phases:
+            self.phases[name] = [0.0, 0, None]
+            self.order.append(name)
+        phase = self.phases[name]
+        phase[0] += seconds
+        phase[1] += calls
+        if memory is not None:
+            phase[2] = max(phase[2] or 0, memory)
+
+    def add_render(self, kind, name, seconds, calls=1):
+        render = self.renders.setdefault((kind, name), [0.0, 0])
+        render[0] += seconds
+        render[1] += calls
+
+    def timed(self, name, fn, kind=None, key=None):
+        """
+        Returns fn wrapped to record its calls as the phase name, and as a render of
+        kind named key(*args) if kind is given
+        """
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = timer()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                self.add(name, elapsed, memory=peak_memory())
+                if kind is not None:
+                    self.add_render(kind, key(*args), elapsed)
+        return wrapper
+
+    def instrument(self, confgen):
+        """
+        Wraps the methods of confgen (and of its inventory, renderer and writers)
+        doing the work of every phase
+        """
+        confgen.timings = self
+        inventory, renderer = confgen.inventory, confgen.renderer
+        inventory.collect = self.timed('inventory collect', inventory.collect)
+        inventory._flush = self.timed('inventory save', inventory._flush)
+        inventory._search_index = self.timed('search index', inventory._search_index)
+        confgen.resolve_inventories = self.timed('inventory merge', confgen.resolve_inventories)
+        confgen.render_leaf = self.timed('render leaf', confgen.render_leaf,
+                                         'leaf', lambda leaf, *args: leaf.path)
+        renderer.render_template = self.timed('render template', renderer.render_template,
+                                              'template', lambda path, *args: path)
+        environment = renderer.jinja_environ
+        environment.compile = self.timed('compile template', environment.compile)
+        open_writer = confgen.open_writer
+
+        def instrumented_writer(*args, **kwargs):
+            writer = open_writer(*args, **kwargs)
+            writer.write = self.timed('write', writer.write)
+            writer.close = self.timed('write close', writer.close)
+            return writer
+        confgen.open_writer = instrumented_writer
+        return confgen
+
+    def drain(self):
+        """
+        Returns what was recorded so far and forgets it (used by build workers)
+        """
+        records = {'phases': dict((k, v[:2]) for k, v in self.phases.items()),
+                   'renders': list(self.renders.items())}
+        self.phases, self.order, self.renders = {}, [], {}
+        return records
+
+    def merge(self, records):
+        for name, (seconds, calls) in sorted(records['phases'].items()):
+            self.add(name, seconds, calls)
+        for (kind, name), (seconds, calls) in records['renders']:
+            self.add_render(kind, name, seconds, calls)
+
+    def report(self, top=10):
+        """
+        Returns the timings as a dict, with the top slowest templates and leaves
+        """
+        def slowest(kind):
+            found = sorted(((v[0], v[1], k[1]) for k, v in self.renders.items() if k[0] == kind),
+                           key=lambda i: (-i[0], i[2]))
+            return [{'name': name, 'seconds': seconds, 'calls': calls}
+                    for seconds, calls, name in found[:top]]
+        return {
+            'total_seconds': timer() - self.start,
+            'peak_bytes': peak_memory(),
+            'workers_peak_bytes': peak_memory('children'),
+            'phases': [{'phase': name, 'seconds': self.phases[name][0],
+                        'calls': self.phases[name][1], 'peak_bytes': self.phases[name][2]}
+                       for name in self.order],
+            'slowest_templates': slowest('template'),
+            'slowest_leaves': slowest('leaf'),
+        }
+
+    def format(self, fmt='table', top=10):
+        report = self.report(top)
+        if fmt == 'json':
+            return json.dumps(report, indent=1, sort_keys=True)
+        import tabulate  # only commands printing tables need it
+
+        def mib(value):
+            return '-' if value is None else '{:.1f}'.format(value / 1024.0 ** 2)
+        tables = [tabulate.tabulate(
+            [(i['phase'], '{:.4f}'.format(i['seconds']), i['calls'], mib(i['peak_bytes']))
+             for i in report['phases']] +
+            [('total', '{:.4f}'.format(report['total_seconds']), '', mib(report['peak_bytes']))],
+            ['phase', 'seconds', 'calls', 'peak MiB'], tablefmt='psql')]
+        for kind in ('templates', 'leaves'):
+            if report['slowest_' + kind]:
+                tables.append(tabulate.tabulate(
+                    [(i['name'], '{:.4f}'.format(i['seconds']), i['calls'])
+                     for i in report['slowest_' + kind]],
+                    ['slowest ' + kind, 'seconds', 'calls'], tablefmt='psql'))
+        return '\n'.join(tables)
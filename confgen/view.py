@@ -1,53 +1,277 @@
-import sys
 import os
-from os.path import join, isfile
+import json
+import errno
+import hashlib
+from os.path import join, isfile, isdir
+from collections import OrderedDict
 
-from jinja2 import Environment, FileSystemLoader, StrictUndefined, exceptions
+from jinja2 import (Environment, FileSystemLoader, FileSystemBytecodeCache,
+                    StrictUndefined, exceptions, meta)
 
-import tabulate
 from logging import getLogger
 
+from . import mkdir_p
+from .search import render_search_result
+
+try:
+    from os import scandir
+except ImportError:  # python 2
+    scandir = None
+
 log = getLogger(__name__)
 
 
+class RenderError(Exception):
+    pass
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """
+    Goes on without storing compiled templates when the cache dir can't be written
+    """
+    warned = False
+
+    def dump_bytecode(self, bucket):
+        try:
+            FileSystemBytecodeCache.dump_bytecode(self, bucket)
+        except (IOError, OSError) as e:
+            if not self.warned:
+                self.warned = True
+                log.warning('Template cache disabled, cannot write to {} ({})'.format(
+                    self.directory, e))
+
+
+def _fingerprint_value(value):
+    # nodes of the infra tree are identified by their path
+    return getattr(value, 'path', repr(value))
+
+
+def _scan_dir(path):
+    """
+    Returns the names of the files and of the directories in path
+    """
+    files, dirs = [], []
+    if scandir is None:
+        for name in os.listdir(path):
+            if isfile(join(path, name)):
+                files.append(name)
+            elif isdir(join(path, name)):
+                dirs.append(name)
+        return files, dirs
+    for entry in scandir(path):
+        if entry.is_file():
+            files.append(entry.name)
+        elif entry.is_dir():
+            dirs.append(entry.name)
+    return files, dirs
+
+
 class Renderer(object):
     templates_dir = 'templates'
     ignore_exts = ["swp", "swo"]
+    # outputs kept by render_cached()
+    rendered_cache_size = 1024
 
-    def __init__(self, home):
+    def __init__(self, home, cache_dir=None):
         self.home = home
         self.jinja_environ = Environment(
             loader=FileSystemLoader(join(home, self.templates_dir)),
-            undefined=StrictUndefined
+            undefined=StrictUndefined,
+            bytecode_cache=self._bytecode_cache(cache_dir)
         )
+        # template name -> dependencies, see dependencies()
+        self._dependencies = {}
+        # service -> templates, see scan()
+        self._services = None
+        # template name -> compiled Template
+        self._compiled = {}
+        # fingerprint -> output of the most recent renders, see render_cached()
+        self._rendered = OrderedDict()
 
-    def service(self, node, anon_service=False):
+    def reset(self):
+        """
+        Forgets what is known about the templates, call it when they change on disk
+        """
+        self._dependencies.clear()
+        self._services = None
+        self._compiled.clear()
+        self._rendered.clear()
+
+    @staticmethod
+    def _bytecode_cache(cache_dir):
+        """
+        Compiled templates are kept in cache_dir between runs, jinja checks the
+        source checksum so changed templates are recompiled
+        """
+        if cache_dir is None:
+            return None
+        try:
+            mkdir_p(cache_dir)
+        except OSError as e:
+            log.warning('Template cache disabled, cannot create {} ({})'.format(cache_dir, e))
+            return None
+        return BytecodeCache(cache_dir)
+
+    def ignored(self, template):
+        return any([template.endswith(i) for i in self.ignore_exts])
+
+    def warm(self):
+        """
+        Compiles every template into the bytecode cache, returns the number compiled
+        """
+        compiled = 0
+        for template in self.jinja_environ.list_templates():
+            if self.ignored(template):
+                continue
+            try:
+                self.jinja_environ.get_template(template)
+                compiled += 1
+            except exceptions.TemplateError as e:
+                log.warning('Cannot compile {} ({})'.format(template, e))
+        return compiled
+
+    def scan(self):
+        """
+        Returns {service: [(filename, template name)]} of the templates that can be
+        rendered, '' for the ones directly in the templates dir. The templates dir is
+        scanned once, until reset().
+        """
+        if self._services is None:
+            templates_path = join(self.home, self.templates_dir)
+            files, dirs = _scan_dir(templates_path)
+            services = {'': files}
+            for subdir in dirs:
+                services[subdir] = _scan_dir(join(templates_path, subdir))[0]
+            for subdir, files in services.items():
+                for template in [i for i in files if self.ignored(i)]:
+                    log.warning('Ignoring file: {} because of its extension'.format(
+                        join(subdir, template)))
+                services[subdir] = [(i, join(subdir, i)) for i in sorted(files)
+                                    if not self.ignored(i)]
+            self._services = services
+        return self._services
+
+    def prepare(self):
+        """
+        Scans the templates dir and compiles every template (e.g. before forking
+        workers, so they share them)
+        """
+        for templates in self.scan().values():
+            for filename, template in templates:
+                try:
+                    self.template(template)
+                except exceptions.TemplateError:  # reported when it's rendered
+                    pass
+
+    def template(self, path):
+        """
+        Returns the compiled template, compiled (or loaded from the cache) once
+        """
+        if path not in self._compiled:
+            self._compiled[path] = self.jinja_environ.get_template(path)
+        return self._compiled[path]
+
+    def templates(self, node, anon_service=False):
+        """
+        Lists (filename, template name) of the templates rendered for the node
+        """
         if anon_service:
             template_subdir = ''
         else:
             template_subdir = node.name
-        templates_path = join(self.home, self.templates_dir, template_subdir)
-        rendered = {}
-        for template in (i for i in os.listdir(templates_path) if isfile(join(templates_path, i))):
-            if any([template.endswith(i) for i in self.ignore_exts]):
-                log.warning('Ignoring file: {} because of its extension'.format(template))
+        try:
+            return self.scan()[template_subdir]
+        except KeyError:
+            path = join(self.home, self.templates_dir, template_subdir)
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def service(self, node, anon_service=False):
+        return dict((filename, self.render_template(template, node))
+                    for filename, template in self.templates(node, anon_service))
+
+    def dependencies(self, path):
+        """
+        Returns ({template: source sha1}, variables) for the template and every
+        template it includes, extends or imports, and the variables they use.
+        None if they can't be known, e.g. the included template is a variable.
+        """
+        if path not in self._dependencies:
+            self._dependencies[path] = self._find_dependencies(path)
+        return self._dependencies[path]
+
+    def _find_dependencies(self, path):
+        templates, variables = {}, set()
+        pending = [path]
+        while pending:
+            current = pending.pop()
+            if current in templates:
                 continue
-            rendered[template] = self.render_template(join(template_subdir, template), node)
-        return rendered
+            try:
+                source = self.jinja_environ.loader.get_source(self.jinja_environ, current)[0]
+                ast = self.jinja_environ.parse(source)
+            except exceptions.TemplateError:  # let rendering report it
+                return None
+            templates[current] = hashlib.sha1(source.encode('utf-8')).hexdigest()
+            variables |= meta.find_undeclared_variables(ast)
+            for referenced in meta.find_referenced_templates(ast):
+                if referenced is None:
+                    return None
+                pending.append(referenced)
+        return templates, frozenset(variables)
+
+    def fingerprint(self, path, inventory, salt=''):
+        """
+        Returns a dict with the fingerprint of rendering the template for the node,
+        which changes whenever the output may change, the templates used and the
+        inventory keys used with the path of the node defining them.
+        None if the dependencies of the template can't be tracked.
+
+        Nodes used as values (the hierarchy levels) are identified by their path,
+        salt has to change with the infra tree.
+        """
+        dependencies = self.dependencies(path)
+        if dependencies is None:
+            return None
+        templates, variables = dependencies
+        context = inventory.as_dict
+        digest = hashlib.sha1(salt.encode('utf-8'))
+        for template in sorted(templates):
+            digest.update(u'{}\0{}\0'.format(template, templates[template]).encode('utf-8'))
+        used = {}
+        for variable in sorted(variables):
+            value = context.get(variable, StrictUndefined)
+            if value is StrictUndefined:  # a global, or rendering will fail
+                continue
+            try:
+                value = json.dumps([variable, value], sort_keys=True, default=_fingerprint_value)
+            except (TypeError, ValueError):
+                return None
+            digest.update(value.encode('utf-8'))
+            sources = context.get(variable + '__source')
+            used[variable] = sources[0] if sources else getattr(context[variable], 'path', None)
+        return {'fingerprint': digest.hexdigest(), 'templates': sorted(templates), 'inventory': used}
 
     def render_template(self, path, inventory):
         try:
-            return self.jinja_environ.get_template(path).render(inventory.as_dict)
+            return self.template(path).render(inventory.as_dict.to_dict())
         except Exception as e:
-            log.error("while rendering: {} ({})".format(
-                join(inventory.path, path), e.message))
-            sys.exit(1)
+            # raised (not logged) so worker processes can hand it back to the parent
+            raise RenderError("while rendering: {} ({})".format(
+                join(inventory.path, path), e))
 
-    @staticmethod
-    def render_search_result(result):
-        table = []
-        for path, inventory in result:
-            for ikey, ivalue in inventory.items():
-                table.append((path, ikey, ivalue))
+    def render_cached(self, path, inventory, fingerprint):
+        """
+        Renders like render_template, unless the template was rendered with the
+        same fingerprint (see fingerprint()) recently: leaves sharing their
+        context get the output rendered for the first one
+        """
+        try:
+            rendered = self._rendered.pop(fingerprint)
+        except KeyError:
+            rendered = self.render_template(path, inventory)
+            if len(self._rendered) >= self.rendered_cache_size:
+                self._rendered.popitem(last=False)
+        self._rendered[fingerprint] = rendered
+        return rendered
 
-        return tabulate.tabulate(table, ['path', 'key', 'value'], tablefmt='psql')
+    render_search_result = staticmethod(render_search_result)
@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+from os.path import join, isfile, relpath
+
+from . import output
+from .view import RenderError
+
+log = logging.getLogger(__name__)
+
+
+def snapshot(paths):
+    """
+    Returns {filename: (size, mtime)} of the files under paths (files or directories)
+    """
+    state = {}
+    for path in paths:
+        if isfile(path):
+            filenames = [path]
+        else:
+            filenames = (join(root, f) for root, dirs, files in os.walk(path) for f in files)
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+            except OSError:  # removed in the meantime
+                continue
+            state[filename] = (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+    return state
+
+
+class Watcher(object):
+    """
+    Keeps a ConfGen (tree, inventory and compiled templates) in memory and re-renders
+    only the outputs affected by changes to the inventory, the templates or
+    confgen.yaml. Changes are found by polling size and mtime of the files.
+    """
+
+    def __init__(self, confgen, interval=0.5):
+        self.confgen = confgen
+        self.interval = interval
+        self.state = snapshot(self.watched())
+
+    def watched(self):
+        confgen = self.confgen
+        return [confgen.inventory.inventory_dir,
+                join(confgen.home, confgen.renderer.templates_dir),
+                confgen.config_path]
+
+    def poll(self):
+        """
+        Returns the files changed, added or removed since the last poll
+        """
+        current = snapshot(self.watched())
+        changed = set(i for i in set(current) | set(self.state)
+                      if current.get(i) != self.state.get(i))
+        self.state = current
+        return changed
+
+    def affected(self, changed):
+        """
+        Returns {leaf: templates to render} for the changed files, None instead of the
+        templates means all of them. Changed inventory files are read again.
+        """
+        confgen = self.confgen
+        templates_dir = join(confgen.home, confgen.renderer.templates_dir)
+        leaves = confgen.root.leaves
+        work = {}
+
+        def add(nodes, template=None):
+            for leaf in nodes:
+                if template is None:
+                    work[leaf.path] = None
+                elif leaf.path not in work or work[leaf.path] is not None:
+                    work.setdefault(leaf.path, set()).add(template)
+
+        for filename in sorted(changed):
+            if filename.startswith(confgen.inventory.inventory_dir + os.sep):
+                if os.path.basename(filename) != confgen.inventory.config_filename:
+                    continue
+                node = confgen.inventory.reload(filename)
+                if node is not None:
+                    add(i for i in node.subtree() if not i.has_children)
+            elif filename.startswith(templates_dir + os.sep):
+                confgen.renderer.reset()
+                template = relpath(filename, templates_dir).split(os.sep)
+                if confgen.renderer.ignored(template[-1]):
+                    continue
+                if confgen.single_service and len(template) == 1:
+                    nodes = leaves
+                elif not confgen.single_service and len(template) == 2:
+                    nodes = [i for i in leaves if i.name == template[0]]
+                else:  # not a service template (e.g. included ones) - could be used anywhere
+                    add(leaves)
+                    continue
+                # a removed template needs the whole leaf rebuilt so its output is removed
+                add(nodes, template[-1] if isfile(filename) else None)
+        return work
+
+    def rebuild(self, changed):
+        """
+        Re-renders the outputs depending on the changed files, returns the number
+        of files written
+        """
+        if self.confgen.config_path in changed:
+            self.confgen = self.confgen.reload()
+            self.state = snapshot(self.watched())
+            return self.confgen.build()
+
+        confgen = self.confgen
+        work = self.affected(changed)
+        scope = []
+        for leaf_path, templates in work.items():
+            dst_dir = leaf_path.lstrip('/')
+            scope.extend([dst_dir] if templates is None else [join(dst_dir, i) for i in templates])
+        writer = output.DirectoryWriter(join(confgen.home, confgen.build_dir), scope)
+        written = 0
+        try:
+            for leaf_path, templates in sorted(work.items()):
+                leaf = confgen.root.by_path(leaf_path)
+                rendered = confgen.render_leaf(leaf, writer.manifest.entries, templates)
+                for filename, (content, entry) in rendered.items():
+                    path = join(leaf_path.lstrip('/'), filename)
+                    if content is None:
+                        writer.keep(path, entry)
+                    else:
+                        written += writer.write(path, content, entry)
+        except Exception:
+            # record what was rewritten, the next build trusts the manifest
+            writer.abort()
+            raise
+        writer.close()
+        return written
+
+    def run(self, jobs=1):
+        """
+        Builds everything once, then rebuilds on changes until interrupted
+        """
+        changed = None
+        try:
+            while True:
+                try:
+                    if changed is None:
+                        self.confgen.build(jobs=jobs)
+                        print("watching {} for changes".format(self.confgen.home))
+                    elif changed:
+                        print("{} files rebuilt".format(self.rebuild(changed)))
+                except RenderError as e:
+                    log.error(e)
+                except Exception as e:  # e.g. broken yaml - keep watching, it will be fixed
+                    log.error("while rebuilding: {}".format(e))
+                time.sleep(self.interval)
+                changed = self.poll()
+        except KeyboardInterrupt:
+            pass
@@ -36,6 +36,13 @@ def confgenyaml_singleservice(singleservice_repo, request):
     return yaml.load(open(os.path.join(singleservice_repo, 'confgen.yaml')))
 
 
+@pytest.fixture(autouse=True)
+def user_cache(tmpdir, monkeypatch):
+    # the CLI caches by default, not in the home of whoever runs the tests
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('user-cache')))
+    return str(tmpdir.join('user-cache'))
+
+
 @pytest.fixture
 def runner(confgenyaml):
     runner = CliRunner()
@@ -1,7 +1,149 @@
+import io
+import os
+import sys
+import json
+import tarfile
+import subprocess
 import confgen
 from confgen import cli
+from confgen.logic import ConfGen
+from confgen.output import ArchiveWriter
 
 def test_version(runner):
     cmd = runner.invoke(cli.version)
     assert cmd.output.strip() == confgen.__version__
     assert cmd.exit_code == 0
+
+
+def test_build_jobs(runner, simplerepo):
+    cmd = runner.invoke(cli.cli, ['--ct-home', simplerepo,
+                                  '--config', os.path.join(simplerepo, 'confgen.yaml'),
+                                  'build', '--jobs', '2'])
+    assert cmd.exit_code == 0
+    assert os.path.isfile(os.path.join(simplerepo, 'build', 'prod', 'main', 'webapp', 'my.cnf'))
+
+
+def test_build_paths(runner, simplerepo):
+    def build(*paths):
+        return runner.invoke(cli.cli, ['--ct-home', simplerepo,
+                                       '--config', os.path.join(simplerepo, 'confgen.yaml'),
+                                       'build'] + list(paths))
+    cmd = build('--path', '/dev/qa1', '-p', '/prod/*/api')
+    assert cmd.exit_code == 0
+    assert sorted(os.listdir(os.path.join(simplerepo, 'build'))) == ['.confgen-manifest', 'dev', 'prod']
+    assert os.listdir(os.path.join(simplerepo, 'build', 'dev')) == ['qa1']
+    assert not os.path.exists(os.path.join(simplerepo, 'build', 'prod', 'main'))
+    assert os.path.isfile(os.path.join(simplerepo, 'build', 'prod', 'staging', 'api', 'my.cnf'))
+
+    assert build('--path', '/nope').exit_code == 1
+
+
+def test_build_archive(runner, simplerepo, tmpdir):
+    def build(*args):
+        return runner.invoke(cli.cli, ['--ct-home', simplerepo,
+                                       '--config', os.path.join(simplerepo, 'confgen.yaml'),
+                                       'build', '--jobs', '1'] + list(args))
+    first, second = str(tmpdir.join('first.tar.gz')), str(tmpdir.join('second.tar.gz'))
+    assert build('--output', first).exit_code == 0
+    assert build('-o', second, '-j', '2').exit_code == 0
+    assert open(first, 'rb').read() == open(second, 'rb').read()
+    assert not os.path.exists(os.path.join(simplerepo, 'build'))
+    with tarfile.open(first) as t:
+        assert t.getnames()[:3] == ['dev/qa1/api/my.cnf', 'dev/qa1/webapp/my.cnf',
+                                    'dev/qa1/webapp/production.ini']
+        assert len(t.getnames()) == 14
+
+    cmd = build('--path', '/prod/main', '--output', '-')
+    assert cmd.exit_code == 0
+    with tarfile.open(fileobj=io.BytesIO(cmd.output_bytes)) as t:
+        assert t.getnames() == ['prod/main/webapp/my.cnf', 'prod/main/webapp/production.ini']
+
+    assert build('--output', str(tmpdir.join('build.rar'))).exit_code == 1
+
+
+def test_render(runner, simplerepo):
+    def render(*args):
+        return runner.invoke(cli.cli, ['--ct-home', simplerepo,
+                                       '--config', os.path.join(simplerepo, 'confgen.yaml'),
+                                       'render'] + list(args))
+    cmd = render('/prod/main/webapp', 'my.cnf')
+    assert cmd.exit_code == 0
+    assert cmd.output == '/ prod main webapp'
+    assert not os.path.exists(os.path.join(simplerepo, 'build'))
+    assert render('/prod/main/webapp', 'nope').exit_code == 1
+
+    # reported as errors, not tracebacks
+    os.rename(os.path.join(simplerepo, 'templates', 'api'), os.path.join(simplerepo, 'api'))
+    for path in ('/dev/qa9/webapp', '/dev/qa1/api'):
+        cmd = render(path, 'my.cnf')
+        assert cmd.exit_code == 1
+        assert isinstance(cmd.exception, SystemExit)
+
+
+def test_cache_warm_and_clear(runner, simplerepo):
+    args = ['--ct-home', simplerepo, '--config', os.path.join(simplerepo, 'confgen.yaml'), 'cache']
+    cache_home = ConfGen.cache_location(simplerepo)
+    cmd = runner.invoke(cli.cli, args + ['warm'])
+    assert cmd.exit_code == 0
+    assert cmd.output.strip() == 'compiled 3 templates'
+    assert os.listdir(os.path.join(cache_home, 'templates'))
+    # nothing that is loaded as code lives in the config repo
+    assert sorted(os.listdir(simplerepo)) == ['confgen.yaml', 'inventory', 'templates']
+
+    cmd = runner.invoke(cli.cli, args + ['clear'])
+    assert cmd.exit_code == 0
+    assert not os.path.exists(cache_home)
+
+
+def test_unwritable_cache(runner, simplerepo, tmpdir, monkeypatch):
+    tmpdir.join('file').write('')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('file', 'cache')))
+    args = ['--ct-home', simplerepo, '--config', os.path.join(simplerepo, 'confgen.yaml')]
+    for command in (['search', 'key', 'prod'], ['render', '/prod/main/webapp', 'my.cnf'],
+                    ['build', '--jobs', '1']):
+        cmd = runner.invoke(cli.cli, args + command)
+        assert cmd.exit_code == 0, cmd.output
+
+
+def test_apply(runner, simplerepo):
+    args = ['--ct-home', simplerepo, '--config', os.path.join(simplerepo, 'confgen.yaml'), 'apply']
+    cmd = runner.invoke(cli.cli, args, input='- {op: set, path: /prod, key: foo, value: bar}\n')
+    assert cmd.exit_code == 0
+    assert 'foo: bar' in open(os.path.join(simplerepo, 'inventory', 'prod', 'config.yaml')).read()
+
+    cmd = runner.invoke(cli.cli, args, input='- {op: set, path: /nope, key: foo, value: bar}\n')
+    assert cmd.exit_code == 1
+
+
+STARTUP = """
+import sys, json
+from confgen import cli
+cli.cli(sys.argv[1:], standalone_mode=False)
+heavy = ['yaml', 'jinja2', 'tabulate', 'confgen.logic', 'confgen.view']
+json.dump([i for i in heavy if i in sys.modules], sys.stderr)
+"""
+
+
+def startup(home, *args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(confgen.__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root] + [i for i in [os.environ.get('PYTHONPATH')] if i]))
+    proc = subprocess.Popen([sys.executable, '-c', STARTUP] + list(args), env=env, cwd=home,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err
+    return json.loads(err.decode('utf-8').splitlines()[-1])
+
+
+def test_startup_imports(simplerepo):
+    # automation runs the CLI thousands of times: commands that don't render
+    # must not pay for importing jinja2 or tabulate
+    assert startup(simplerepo, 'version') == []
+    assert startup(simplerepo, 'set', '/prod', 'foo', 'bar') == ['yaml', 'confgen.logic']
+    assert startup(simplerepo, 'delete', '/prod', 'foo') == ['yaml', 'confgen.logic']
+    assert 'jinja2' in startup(simplerepo, 'render', '/prod/main/webapp', 'my.cnf')
+
+
+def test_archive_formats():
+    format_option = [i for i in cli.build.params if i.name == 'archive_format'][0]
+    assert tuple(format_option.type.choices) == ArchiveWriter.formats
@@ -1,6 +1,16 @@
+import os
+import sys
+import shutil
 import pytest
+import threading
+import multiprocessing
 from os.path import join
 
+from confgen import logic
+from confgen.logic import ConfGen
+from confgen.output import Manifest
+from confgen.view import RenderError
+
 
 def test_confgen_tree_build(confgen):
     '''
@@ -131,6 +141,50 @@ def test_confgen_tree_leaves(confgen):
     }
 
 
+def test_confgen_tree_index(confgen):
+    index = confgen.root.index
+    assert len(index.nodes) == 17
+    assert index.nodes[0] is confgen.root
+    assert list(index.parents[:3]) == [-1, 0, 1]
+    # breadth first: the root, the stages, the clusters, the services
+    assert [i.path for i in confgen.root.all()][:3] == ['/', '/prod', '/dev']
+    assert [i.level for i in confgen.root.all()][-9:] == ['SERVICE'] * 9
+    assert confgen.root.leaves is index.leaves
+    prod = confgen.root.by_path('/prod')
+    assert sorted(i.path for i in prod.subtree()) == [
+        '/prod', '/prod/main', '/prod/main/webapp', '/prod/multiapp', '/prod/multiapp/api',
+        '/prod/multiapp/webapp', '/prod/staging', '/prod/staging/api', '/prod/staging/webapp']
+
+
+def test_confgen_tree_path_index(confgen):
+    index = confgen.root.index
+    assert index.paths[:4] == ['/', '/dev', '/dev/qa1', '/dev/qa1/api']
+    assert all(confgen.root.by_path(p).path == p for p in index.paths)
+    assert all(i.root is confgen.root for i in index.nodes)
+    assert [i.path for i in index.match('/dev/qa?/api')] == ['/dev/qa1/api', '/dev/qa2/api']
+    # wildcards match within a segment, as in a shell
+    assert [i.path for i in index.match('/prod/m*')] == ['/prod/main', '/prod/multiapp']
+    assert [i.path for i in index.match('/*/*/api')] == [
+        '/dev/qa1/api', '/dev/qa2/api', '/prod/multiapp/api', '/prod/staging/api']
+    assert [i.path for i in index.match('/')] == ['/']
+    assert index.match('/nope*') == []
+
+
+def test_confgen_tree_nodes_are_compact(confgen):
+    leaves = confgen.root.leaves
+    # names and levels are shared, as are the children of leaves
+    assert leaves[0].level is leaves[-1].level
+    webapps = [i for i in leaves if i.name == 'webapp']
+    assert webapps[0].name is webapps[1].name
+    assert leaves[0].children is leaves[1].children
+    assert confgen.root.by_path('/dev').children is not confgen.root.by_path('/prod').children
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason='the python 2 ABCs have no __slots__')
+def test_confgen_tree_nodes_have_no_dict(confgen):
+    assert not hasattr(confgen.root.leaves[0], '__dict__')
+
+
 def test_confgen_build(confgen):
     confgen.build()
 
@@ -149,3 +203,250 @@ def test_confgen_build(confgen):
     assert f('dev/qa2/webapp/my.cnf') == "/ dev qa2 webapp"
     assert f('dev/qa2/webapp/production.ini') == "9.0 password qa1 qa2"
     assert f('dev/qa2/api/my.cnf') == "/ dev qa2 api"
+
+
+def test_confgen_build_is_incremental(confgen):
+    confgen.build()
+    land_dir = join(confgen.home, confgen.build_dir)
+    unchanged = join(land_dir, 'prod/main/webapp/my.cnf')
+    changed = join(land_dir, 'dev/qa1/webapp/production.ini')
+    for p in (unchanged, changed):
+        os.utime(p, (1, 1))
+
+    confgen.set('/dev/qa1', 'mysql', 5.0)
+    confgen.build()
+
+    assert os.stat(unchanged).st_mtime == 1
+    assert os.stat(changed).st_mtime != 1
+    assert open(changed).read() == "5.0 password qa1 qa2"
+
+
+def test_confgen_build_renders_changed_dependencies_only(confgen, monkeypatch):
+    confgen.build()
+    manifest = Manifest(join(confgen.home, confgen.build_dir)).load()
+    entry = manifest.entries['dev/qa1/webapp/production.ini']
+    assert entry['templates'] == ['webapp/production.ini']
+    assert entry['inventory'] == {'mysql': '/dev/qa1', 'secret': '/', 'STAGE': '/dev'}
+
+    rendered = []
+    render_template = confgen.renderer.render_template
+    monkeypatch.setattr(confgen.renderer, 'render_template',
+                        lambda path, node: rendered.append((node.path, path)) or
+                        render_template(path, node))
+    confgen.build()
+    assert rendered == []
+
+    confgen.set('/dev', 'secret', 'dev')
+    confgen.build()
+    assert rendered == [('/dev/qa1/webapp', 'webapp/production.ini'),
+                        ('/dev/qa2/webapp', 'webapp/production.ini')]
+
+    # outputs removed from the build dir are rendered again
+    del rendered[:]
+    os.unlink(join(confgen.home, confgen.build_dir, 'prod/main/webapp/my.cnf'))
+    assert confgen.build() == 1
+    assert rendered == [('/prod/main/webapp', 'webapp/my.cnf')]
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_confgen_build_corrects_outputs_replaced_since(confgen, jobs):
+    confgen.build(jobs=jobs)
+    path = join(confgen.home, confgen.build_dir, 'dev/qa1/webapp/production.ini')
+    built = open(path).read()
+    # the same size, e.g. build/ checked out from another branch
+    os.unlink(path)
+    with open(path, 'w') as f:
+        f.write('x' * len(built))
+    assert confgen.build(jobs=jobs) == 1
+    assert open(path).read() == built
+
+
+@pytest.mark.parametrize('paths,expected', (
+    (['/prod/main'], ['/prod/main/webapp']),
+    (['/dev/*/api', 'prod/staging/'], ['/prod/staging/webapp', '/prod/staging/api',
+                                       '/dev/qa1/api', '/dev/qa2/api']),
+    (['/*/qa?'], ['/dev/qa1/webapp', '/dev/qa1/api', '/dev/qa2/webapp', '/dev/qa2/api']),
+    (['/*/api'], []),
+    (['/*/*/api'], ['/prod/multiapp/api', '/prod/staging/api', '/dev/qa1/api', '/dev/qa2/api']),
+    (['/'], None),
+    (['/nope'], []),
+))
+def test_confgen_match_leaves(confgen, paths, expected):
+    if expected is None:
+        expected = [i.path for i in confgen.root.leaves]
+    assert [i.path for i in confgen.match_leaves(paths)] == expected
+
+
+def test_confgen_build_paths(simplerepo):
+    confgen = ConfGen(simplerepo, open(join(simplerepo, 'confgen.yaml')))
+    confgen.build()
+    land_dir = join(confgen.home, confgen.build_dir)
+    with open(join(confgen.home, 'templates', 'webapp', 'my.cnf'), 'w') as f:
+        f.write('changed')
+
+    # only the inventory files on the way to the matching leaves are read
+    confgen = ConfGen(simplerepo, open(join(simplerepo, 'confgen.yaml')), lazy=True)
+    assert confgen.build(paths=['/prod/main']) == 1
+    assert sorted(confgen.inventory._sources) == ['/', '/prod', '/prod/main']
+    assert open(join(land_dir, 'prod/main/webapp/my.cnf')).read() == 'changed'
+    assert open(join(land_dir, 'dev/qa1/webapp/my.cnf')).read() == '/ dev qa1 webapp'
+    assert open(join(land_dir, 'prod/main/webapp/production.ini')).read() == \
+        "3.0 password main multiapp staging"
+
+    with pytest.raises(ValueError):
+        confgen.build(paths=['/nope'])
+
+
+def test_confgen_build_renders_shared_contexts_once(confgen, monkeypatch):
+    rendered = []
+    render_template = confgen.renderer.render_template
+    monkeypatch.setattr(confgen.renderer, 'render_template',
+                        lambda path, node: rendered.append((node.path, path)) or
+                        render_template(path, node))
+    confgen.build()
+    # both use mysql and secret of /prod, and the same STAGE
+    assert ('/prod/multiapp/webapp', 'webapp/production.ini') in rendered
+    assert ('/prod/staging/webapp', 'webapp/production.ini') not in rendered
+    assert len(rendered) == 13
+    land_dir = join(confgen.home, confgen.build_dir)
+    assert open(join(land_dir, 'prod/staging/webapp/production.ini')).read() == \
+        "2.0 password main multiapp staging"
+
+
+def test_confgen_build_store(confgen):
+    confgen.build(store=True)
+    land_dir = join(confgen.home, confgen.build_dir)
+    multiapp = os.stat(join(land_dir, 'prod/multiapp/webapp/production.ini'))
+    staging = os.stat(join(land_dir, 'prod/staging/webapp/production.ini'))
+    assert multiapp.st_ino == staging.st_ino
+    assert os.path.isdir(join(confgen.home, confgen.store_dir))
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_confgen_build_store_on_existing_build(confgen, jobs):
+    confgen.build(jobs=jobs)
+    built = read_build(confgen)
+    # turning the store on links the outputs already there, without changing them
+    assert confgen.build(jobs=jobs, store=True) == 0
+    land_dir = join(confgen.home, confgen.build_dir)
+    multiapp = os.stat(join(land_dir, 'prod/multiapp/webapp/production.ini'))
+    staging = os.stat(join(land_dir, 'prod/staging/webapp/production.ini'))
+    assert multiapp.st_ino == staging.st_ino
+    assert all(os.stat(join(land_dir, path)).st_nlink > 1 for path in built['manifest'])
+    assert read_build(confgen) == built
+
+
+def test_confgen_render(simplerepo):
+    confgen = ConfGen(simplerepo, open(join(simplerepo, 'confgen.yaml')), lazy=True)
+    assert confgen.render('/dev/qa2/webapp', 'production.ini') == "9.0 password qa1 qa2"
+    assert sorted(confgen.inventory._sources) == ['/', '/dev/qa2']
+    assert sorted(confgen.renderer._compiled) == ['webapp/production.ini']
+    for path, template, error in (
+            ('/dev/qa2', 'my.cnf', '/dev/qa2 is not a leaf'),
+            ('/dev/qa3/api', 'my.cnf', 'no node /dev/qa3/api'),
+            ('/dev/qa2/api', 'production.ini', 'no template production.ini for /dev/qa2/api')):
+        with pytest.raises(KeyError) as e:
+            confgen.render(path, template)
+        assert e.value.args[0] == error
+
+    os.rename(join(simplerepo, 'templates', 'api'), join(simplerepo, 'api'))
+    confgen.renderer.reset()
+    with pytest.raises(KeyError) as e:
+        confgen.render('/dev/qa2/api', 'my.cnf')
+    assert e.value.args[0] == 'no templates for api'
+
+
+def test_confgen_build_removes_stale_outputs(confgen):
+    land_dir = join(confgen.home, confgen.build_dir)
+    os.makedirs(join(land_dir, 'prod/gone'))
+    open(join(land_dir, 'prod/gone/my.cnf'), 'w').write('stale')
+    confgen.build()
+    assert not os.path.exists(join(land_dir, 'prod/gone'))
+    assert os.path.exists(join(land_dir, 'prod/main/webapp/my.cnf'))
+
+
+def read_build(confgen):
+    land_dir = join(confgen.home, confgen.build_dir)
+    built = {join(root, f): open(join(root, f)).read()
+             for root, dirs, files in os.walk(land_dir) for f in files
+             if f != Manifest.filename}
+    # mtimes and inodes differ from build to build
+    built['manifest'] = {path: dict((k, v) for k, v in entry.items()
+                                    if k not in ('mtime_ns', 'inode'))
+                         for path, entry in Manifest(land_dir).load().entries.items()}
+    return built
+
+
+def test_confgen_parallel_build(confgen):
+    confgen.build()
+    serial = read_build(confgen)
+    shutil.rmtree(join(confgen.home, confgen.build_dir))
+    assert confgen.build(jobs=3, write_threads=2) == 14
+    assert read_build(confgen) == serial
+
+
+def test_confgen_build_forks_before_starting_write_threads(confgen, monkeypatch):
+    # forking a process running threads can deadlock the children
+    context = logic._fork_context()
+    running = []
+
+    class Context(object):
+        def Pool(self, *args):
+            running.append(threading.active_count())
+            return context.Pool(*args)
+    monkeypatch.setattr(logic, '_fork_context', Context)
+    before = threading.active_count()
+    assert confgen.build(jobs=3, write_threads=2) == 14
+    assert running == [before]
+
+
+@pytest.mark.parametrize('jobs', (1, 3))
+def test_confgen_build_render_error(confgen, jobs):
+    with open(join(confgen.home, 'templates', 'api', 'my.cnf'), 'w') as f:
+        f.write('{{ missing }}')
+    with pytest.raises(RenderError) as e:
+        confgen.build(jobs=jobs)
+    # the first failing leaf is reported no matter how many processes render
+    first = [i for i in confgen.root.leaves if i.name == 'api'][0]
+    assert str(e.value) == "while rendering: {}/api/my.cnf ('missing' is undefined)".format(first.path)
+
+
+@pytest.mark.parametrize('jobs', (1, 3))
+def test_confgen_build_keeps_outputs_written_before_error(confgen, jobs):
+    with open(join(confgen.home, 'templates', 'api', 'my.cnf'), 'w') as f:
+        f.write('{{ missing }}')
+    with pytest.raises(RenderError):
+        confgen.build(jobs=jobs, inflight=1)
+    # leaves before the failing one are written as they are rendered
+    land_dir = join(confgen.home, confgen.build_dir)
+    assert open(join(land_dir, 'prod/main/webapp/my.cnf')).read() == "/ prod main webapp"
+    assert 'prod/main/webapp/my.cnf' in Manifest(land_dir).load().entries
+    assert not os.path.exists(join(land_dir, 'dev'))
+
+
+def test_confgen_iter_render(confgen):
+    leaves = confgen.root.leaves
+    serial = [(leaf.path, rendered) for leaf, rendered in confgen.iter_render(leaves)]
+    assert [path for path, rendered in serial] == [i.path for i in leaves]
+    parallel = confgen.iter_render(leaves, jobs=3, inflight=2)
+    assert [(leaf.path, rendered) for leaf, rendered in parallel] == serial
+
+
+@pytest.mark.skipif(not hasattr(multiprocessing, 'set_start_method'),
+                    reason='python 2 always forks')
+def test_confgen_build_spawn_start_method(confgen):
+    # the default on macos, and forkserver on linux from python 3.14
+    default = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method('spawn', force=True)
+    try:
+        assert confgen.build(jobs=3) == 14
+    finally:
+        multiprocessing.set_start_method(default, force=True)
+
+
+def test_confgen_iter_render_without_fork(confgen, monkeypatch):
+    leaves = confgen.root.leaves
+    serial = [(leaf.path, rendered) for leaf, rendered in confgen.iter_render(leaves)]
+    monkeypatch.setattr(logic, '_fork_context', lambda: None)
+    parallel = confgen.iter_render(leaves, jobs=3)
+    assert [(leaf.path, rendered) for leaf, rendered in parallel] == serial
@@ -1,7 +1,12 @@
+import io
+import os
 from os.path import join
 import pytest
 import yaml
 
+from confgen.inventory import Inventory, ParsedCache, read_operations
+from confgen.logic import ChainedDict
+
 def assert_collected_inventory(tree):
     assert tree.inventory['mysql'] == 1.0
     assert tree.inventory['secret'] == 'password'
@@ -131,3 +136,201 @@ def test_flush(inventory):
     assert open_inv(inventory, "prod/main") == {'mysql': 3.0}
     assert open_inv(inventory, "dev/qa1") == {'mysql': 4.0}
     assert open_inv(inventory, "dev/qa2") == {'mysql': 9.0, 'new_key': 'my_value'}
+
+
+def test_flatten_is_cached(inventory):
+    node = inventory._tree.by_path('/prod/main/webapp')
+    assert node.as_dict is node.as_dict
+    assert node.flatten is node.flatten
+
+
+def test_set_invalidates_subtree(inventory):
+    t = inventory._tree
+    sibling = t['dev']['qa1'].as_dict
+    leaf = t['prod']['main']['webapp'].as_dict
+    assert leaf['mysql'] == 3.0
+
+    inventory.set('/prod', 'mysql', 2.5)
+    inventory.set('/prod/main', 'foo', 'bar')
+    assert t['prod']['main']['webapp'].as_dict['foo'] == 'bar'
+    assert t['prod']['multiapp']['api'].as_dict['mysql'] == 2.5
+    assert t['dev']['qa1'].as_dict is sibling
+
+    inventory.delete('/prod/main', 'mysql')
+    assert t['prod']['main']['webapp'].as_dict['mysql'] == 2.5
+    assert t['prod']['main']['webapp'].as_dict['mysql__source'] == ['/prod', '/']
+
+
+def test_flatten_shares_parent_inventory(inventory):
+    t = inventory._tree
+    # nodes without own inventory reuse the merged inventory of their parent
+    assert t['prod']['main']['webapp'].flatten is t['prod']['main'].flatten
+    # nodes with inventory only add their own layer on top of the parent
+    assert t['prod']['main'].flatten.maps[1:] == t['prod'].flatten.maps
+    assert dict(t['prod']['main'].flatten) == {
+        'mysql': 3.0,
+        'mysql__source': ['/prod/main', '/prod', '/'],
+        'secret': 'password',
+        'secret__source': ['/'],
+    }
+
+
+def test_chained_dict():
+    d = ChainedDict({'a': 1}, {'a': 2, 'b': 3})
+    assert d['a'] == 1
+    assert d['b'] == 3
+    assert 'b' in d and 'c' not in d
+    assert len(d) == 2
+    assert sorted(d) == ['a', 'b']
+    assert d.to_dict() == {'a': 1, 'b': 3}
+    assert d.new_child({'b': 4})['b'] == 4
+    assert d['b'] == 3
+
+
+def test_set_rewrites_only_modified_node(inventory):
+    untouched = join(inventory.inventory_dir, 'dev', 'qa1', 'config.yaml')
+    with open(untouched, 'w') as f:
+        f.write('# keep me\nmysql: 4.0\n')
+    inventory.set('/prod', 'foo', 'bar')
+    assert open(untouched).read() == '# keep me\nmysql: 4.0\n'
+    assert open_inv(inventory, 'prod') == {'mysql': 2.0, 'foo': 'bar'}
+    assert not [i for i in os.listdir(join(inventory.inventory_dir, 'prod')) if i.endswith('.tmp')]
+
+
+def test_delete_last_key_prunes_empty_dirs(inventory):
+    inventory.set('/prod/main/webapp', 'foo', 'bar')
+    inventory.delete('/prod/main/webapp', 'foo')
+    assert not os.path.exists(join(inventory.inventory_dir, 'prod', 'main', 'webapp'))
+    assert open_inv(inventory, 'prod/main') == {'mysql': 3.0}
+
+
+def test_apply_operations(inventory):
+    assert inventory.apply([
+        {'op': 'set', 'path': '/prod', 'key': 'foo', 'value': 1},
+        {'op': 'set', 'path': '/prod/main/webapp', 'key': 'bar', 'value': 'baz'},
+        {'op': 'delete', 'path': '/dev/qa2', 'key': 'new_key'},
+        {'op': 'delete', 'path': '/dev/qa3', 'key': 'mysql'},
+        {'op': 'delete', 'path': '/dev/qa1', 'key': 'psql'},
+    ]) == 5
+    assert open_inv(inventory, 'prod') == {'mysql': 2.0, 'foo': 1}
+    assert open_inv(inventory, 'prod/main/webapp') == {'bar': 'baz'}
+    assert open_inv(inventory, 'dev/qa2') == {'mysql': 9.0}
+    assert inventory._tree.by_path('/prod/main/webapp').as_dict['foo'] == 1
+
+
+@pytest.mark.parametrize('operation', (
+    {'op': 'set', 'path': '/prod/staging/demo1', 'key': 'foo', 'value': 'bar'},
+    {'op': 'set', 'path': '/prod', 'key': 'foo'},
+    {'op': 'rename', 'path': '/prod', 'key': 'foo'},
+    'set /prod foo bar',
+))
+def test_apply_invalid_operation(inventory, operation):
+    with pytest.raises(ValueError):
+        inventory.apply([{'op': 'set', 'path': '/prod', 'key': 'foo', 'value': 'bar'}, operation])
+    assert 'foo' not in inventory._tree['prod'].inventory
+    assert open_inv(inventory, 'prod') == {'mysql': 2.0}
+
+
+@pytest.mark.parametrize('text', (
+    u'{"op": "set", "path": "/prod", "key": "foo", "value": 1}\n'
+    u'\n'
+    '{"op": "delete", "path": "/prod", "key": "mysql"}\n',
+    u'- {op: set, path: /prod, key: foo, value: 1}\n'
+    '- {op: delete, path: /prod, key: mysql}\n',
+    u'op: set\npath: /prod\nkey: foo\nvalue: 1\n'
+    '---\n'
+    'op: delete\npath: /prod\nkey: mysql\n',
+))
+def test_read_operations(text):
+    assert read_operations(io.StringIO(text)) == [
+        {'op': 'set', 'path': '/prod', 'key': 'foo', 'value': 1},
+        {'op': 'delete', 'path': '/prod', 'key': 'mysql'},
+    ]
+
+
+def test_read_operations_yaml_flow_style():
+    # starts with { but isn't JSON
+    assert read_operations(io.StringIO(u'{op: set, path: /prod, key: foo, value: bar}\n')) == [
+        {'op': 'set', 'path': '/prod', 'key': 'foo', 'value': 'bar'}]
+    with pytest.raises(ValueError):
+        read_operations(io.StringIO(u'{op: set, path: [/prod}\n'))
+
+
+def test_parsed_cache(simplerepo, tmpdir, monkeypatch):
+    cache_path = str(tmpdir.join('cache', 'inventory'))
+    filename = join(simplerepo, 'inventory', 'dev', 'qa2', 'config.yaml')
+    cache = ParsedCache(cache_path)
+    parsed = cache.load(filename)
+    assert parsed == {'mysql': 9.0, 'new_key': 'my_value'}
+    cache.save()
+
+    # unchanged files come from the cache, as independent copies
+    monkeypatch.setattr('confgen.inventory.yaml_load', None)
+    cache = ParsedCache(cache_path)
+    cached = cache.load(filename)
+    assert cached == parsed
+    cached['mysql'] = 1
+    assert cache.load(filename)['mysql'] == 9.0
+
+    # changed files are parsed again
+    monkeypatch.undo()
+    with open(filename, 'w') as f:
+        f.write('mysql: 10.0\n')
+    assert ParsedCache(cache_path).load(filename) == {'mysql': 10.0}
+
+
+def test_inventory_with_cache(confgen, tmpdir):
+    cache_dir = str(tmpdir)
+    Inventory(confgen.root, confgen.home, cache_dir)
+    assert os.path.isfile(join(cache_dir, 'inventory'))
+    assert_collected_inventory(Inventory(confgen.root, confgen.home, cache_dir)._tree)
+
+
+def test_search_index_is_persisted(confgen, tmpdir):
+    cache_dir = str(tmpdir)
+    inventory = Inventory(confgen.root, confgen.home, cache_dir)
+    assert {i[0] for i in inventory.search_value('mysql')} == {
+        '/', '/prod', '/prod/main', '/dev/qa1', '/dev/qa2'}
+    assert os.path.isfile(join(cache_dir, 'search-values'))
+
+    reloaded = Inventory(confgen.root, confgen.home, cache_dir)
+    reloaded._build_index = None  # must come from the cache
+    assert reloaded.search_value('my_value') == [('/dev/qa2', {'new_key': 'my_value'})]
+
+
+def test_search_index_follows_edits(inventory):
+    assert inventory.search_value('bar') == []
+    inventory.set('/prod', 'foo', 'bar')
+    assert inventory.search_value('bar') == [('/prod', {'foo': 'bar'})]
+    inventory.delete('/prod', 'foo')
+    assert inventory.search_value('bar') == []
+
+
+def test_parsed_cache_kept_by_partial_collect(confgen, tmpdir):
+    cache_dir = str(tmpdir)
+    Inventory(confgen.root, confgen.home, cache_dir)
+    cached = ParsedCache(join(cache_dir, 'inventory')).entries
+    assert len(cached) == 5
+
+    # e.g. confgen render reads the files of one leaf and its ancestors only
+    inventory = Inventory(confgen.root, confgen.home, cache_dir, lazy=True)
+    inventory.collect([confgen.root.by_path('/dev/qa2/webapp')])
+    assert ParsedCache(join(cache_dir, 'inventory')).entries == cached
+
+    # removed files are dropped once every file was read again
+    os.unlink(join(confgen.home, 'inventory', 'dev', 'qa2', 'config.yaml'))
+    Inventory(confgen.root, confgen.home, cache_dir)
+    assert len(ParsedCache(join(cache_dir, 'inventory')).entries) == 4
+
+
+def test_unwritable_cache(confgen, tmpdir, caplog):
+    tmpdir.join('file').write('')
+    cache_dir = str(tmpdir.join('file', 'cache'))  # can't be created
+    inventory = Inventory(confgen.root, confgen.home, cache_dir)
+    assert_collected_inventory(inventory._tree)
+    assert inventory.search_value('my_value') == [('/dev/qa2', {'new_key': 'my_value'})]
+    inventory.set('/prod', 'foo', 'bar')
+    # warned about once, the commands go on without it
+    warnings = [r.getMessage() for r in caplog.records if r.levelname == 'WARNING']
+    assert len(warnings) == 1
+    assert warnings[0].startswith('Cache disabled, cannot write ' + join(cache_dir, 'inventory'))
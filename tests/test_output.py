@@ -0,0 +1,279 @@
+import io
+import os
+import time
+import shutil
+import tarfile
+import zipfile
+from os.path import join, exists
+
+import pytest
+
+from confgen.output import ArchiveWriter, DirectoryWriter, Manifest
+
+
+def mtime(path):
+    return os.stat(path).st_mtime
+
+
+def test_writer_writes_new_files(tmpdir):
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir)
+    assert writer.write(join('prod', 'my.cnf'), u'foo') is True
+    writer.close()
+
+    assert open(join(land_dir, 'prod', 'my.cnf')).read() == 'foo'
+    assert set(Manifest(land_dir).load().entries) == {join('prod', 'my.cnf')}
+
+
+def test_writer_skips_unchanged_files(tmpdir):
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir)
+    writer.write('my.cnf', u'foo')
+    writer.close()
+    os.utime(join(land_dir, 'my.cnf'), (1, 1))
+
+    writer = DirectoryWriter(land_dir)
+    assert writer.write('my.cnf', u'foo') is False
+    assert writer.write('production.ini', u'bar') is True
+    writer.close()
+    assert mtime(join(land_dir, 'my.cnf')) == 1
+
+
+def test_writer_rewrites_changed_files(tmpdir):
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir)
+    writer.write('my.cnf', u'foo')
+    writer.close()
+
+    writer = DirectoryWriter(land_dir)
+    assert writer.write('my.cnf', u'baz') is True
+    writer.close()
+    assert open(join(land_dir, 'my.cnf')).read() == 'baz'
+
+
+def test_writer_rewrites_files_replaced_since(tmpdir):
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir)
+    writer.write('my.cnf', u'foo')
+    writer.close()
+    entry = Manifest(land_dir).load().entries['my.cnf']
+    assert set(entry) == {'sha1', 'size', 'mtime_ns', 'inode'}
+
+    # e.g. build/ checked out from another branch, the manifest left behind
+    os.unlink(join(land_dir, 'my.cnf'))
+    with open(join(land_dir, 'my.cnf'), 'w') as f:
+        f.write('bar')
+    writer = DirectoryWriter(land_dir)
+    assert writer.write('my.cnf', u'foo') is True
+    writer.close()
+    assert open(join(land_dir, 'my.cnf')).read() == 'foo'
+
+
+def test_writer_removes_stale_outputs(tmpdir):
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir)
+    writer.write(join('prod', 'main', 'my.cnf'), u'foo')
+    writer.write(join('dev', 'my.cnf'), u'bar')
+    writer.close()
+
+    writer = DirectoryWriter(land_dir)
+    writer.write(join('dev', 'my.cnf'), u'bar')
+    assert writer.stale() == [join('prod', 'main', 'my.cnf')]
+    writer.close()
+    assert not exists(join(land_dir, 'prod'))
+    assert exists(join(land_dir, 'dev', 'my.cnf'))
+
+
+def test_writer_without_manifest_removes_unknown_files(tmpdir):
+    land_dir = tmpdir.mkdir('build')
+    land_dir.join('leftover.cnf').write('old')
+    land_dir.join('my.cnf').write('foo')
+    os.utime(str(land_dir.join('my.cnf')), (1, 1))
+
+    writer = DirectoryWriter(str(land_dir))
+    assert writer.write('my.cnf', u'foo') is False
+    writer.close()
+    assert not land_dir.join('leftover.cnf').exists()
+    assert mtime(str(land_dir.join('my.cnf'))) == 1
+
+
+def test_writer_scope(tmpdir):
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir)
+    for path in ('prod/main/my.cnf', 'prod/main/production.ini', 'dev/qa1/my.cnf'):
+        writer.write(path, u'old')
+    writer.close()
+
+    writer = DirectoryWriter(land_dir, scope=['prod/main/my.cnf', 'dev'])
+    assert writer.in_scope('dev/qa1/my.cnf')
+    assert not writer.in_scope('prod/main/production.ini')
+    assert not writer.in_scope('prod/main/my.cnf.bak')
+    writer.write('prod/main/my.cnf', u'new')
+    assert writer.stale() == ['dev/qa1/my.cnf']
+    writer.close()
+
+    assert open(join(land_dir, 'prod/main/my.cnf')).read() == 'new'
+    assert open(join(land_dir, 'prod/main/production.ini')).read() == 'old'
+    assert not exists(join(land_dir, 'dev'))
+    assert set(Manifest(land_dir).load().entries) == {'prod/main/my.cnf', 'prod/main/production.ini'}
+
+
+def test_writer_store(tmpdir):
+    land_dir, store = str(tmpdir.join('build')), str(tmpdir.join('store'))
+    writer = DirectoryWriter(land_dir, store=store)
+    for path in ('qa1/my.cnf', 'qa2/my.cnf', 'prod/my.cnf'):
+        writer.write(path, u'same' if path.startswith('qa') else u'other')
+    writer.close()
+
+    qa1, qa2 = os.stat(join(land_dir, 'qa1/my.cnf')), os.stat(join(land_dir, 'qa2/my.cnf'))
+    assert qa1.st_ino == qa2.st_ino
+    assert qa1.st_nlink == 3  # and the blob in the store
+    assert sum(len(files) for root, dirs, files in os.walk(store)) == 2
+
+    # rewriting a linked output, with or without the store, leaves the others alone
+    writer = DirectoryWriter(land_dir)
+    writer.write('qa1/my.cnf', u'changed')
+    writer.write('qa2/my.cnf', u'same')
+    writer.close()
+    assert open(join(land_dir, 'qa2/my.cnf')).read() == 'same'
+
+    # blobs no output links to are removed, outputs written without the store are
+    # linked to it even when unchanged
+    writer = DirectoryWriter(land_dir, store=store)
+    assert writer.write('qa1/my.cnf', u'changed') is False
+    writer.write('qa2/my.cnf', u'fresh')
+    writer.close()
+    assert open(join(land_dir, 'qa2/my.cnf')).read() == 'fresh'
+    assert os.stat(join(land_dir, 'qa2/my.cnf')).st_nlink == 2
+    assert os.stat(join(land_dir, 'qa1/my.cnf')).st_nlink == 2
+    assert sum(len(files) for root, dirs, files in os.walk(store)) == 2
+
+
+def test_writer_store_blobs_read_only(tmpdir):
+    land_dir, store = str(tmpdir.join('build')), str(tmpdir.join('store'))
+    writer = DirectoryWriter(land_dir, store=store)
+    for path in ('qa1/my.cnf', 'qa2/my.cnf'):
+        writer.write(path, u'same')
+    writer.close()
+    assert os.stat(join(land_dir, 'qa1/my.cnf')).st_mode & 0o777 == 0o444
+
+    # edited in place anyway: the blob is replaced, not reused
+    os.chmod(join(land_dir, 'qa1/my.cnf'), 0o644)
+    with open(join(land_dir, 'qa1/my.cnf'), 'w') as f:
+        f.write('edited in place')
+    writer = DirectoryWriter(land_dir, store=store)
+    for path in ('qa1/my.cnf', 'qa2/my.cnf', 'qa3/my.cnf'):
+        writer.write(path, u'same')
+    writer.close()
+    for path in ('qa1/my.cnf', 'qa2/my.cnf', 'qa3/my.cnf'):
+        assert open(join(land_dir, path)).read() == 'same'
+    assert os.stat(join(land_dir, 'qa3/my.cnf')).st_nlink == 4
+
+    # outputs left read-only by a store are replaced by builds without it
+    shutil.rmtree(store)
+    writer = DirectoryWriter(land_dir)
+    writer.write('qa1/my.cnf', u'changed')
+    writer.close()
+    assert open(join(land_dir, 'qa1/my.cnf')).read() == 'changed'
+
+
+def test_writer_threads(tmpdir):
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir, threads=3)
+    for i in range(50):
+        assert writer.write(join('leaf{}'.format(i % 5), 'file{}'.format(i)), u'x' * i) is None
+    writer.close()
+    assert writer.written == 50
+    assert open(join(land_dir, 'leaf4', 'file49')).read() == 'x' * 49
+    assert len(Manifest(land_dir).load().entries) == 50
+
+    writer = DirectoryWriter(land_dir, threads=3)
+    for i in range(50):
+        writer.write(join('leaf{}'.format(i % 5), 'file{}'.format(i)), u'x' * i)
+    writer.close()
+    assert writer.written == 0
+
+
+def test_writer_threads_store(tmpdir):
+    # threads storing the same new blob at once must all end up linked to it
+    land_dir, store = str(tmpdir.join('build')), str(tmpdir.join('store'))
+    writer = DirectoryWriter(land_dir, store=store, threads=8)
+    for i in range(200):
+        writer.write(join('leaf{}'.format(i), 'my.cnf'), u'content {}'.format(i % 10))
+    writer.close()
+    inodes = {}
+    for i in range(200):
+        stat = os.stat(join(land_dir, 'leaf{}'.format(i), 'my.cnf'))
+        inodes.setdefault(i % 10, set()).add(stat.st_ino)
+    assert [len(i) for i in inodes.values()] == [1] * 10
+    blobs = [f for root, dirs, files in os.walk(store) for f in files]
+    assert len(blobs) == 10 and not [f for f in blobs if f.endswith('.tmp')]
+
+
+def test_writer_threads_error(tmpdir):
+    land_dir = tmpdir.mkdir('build')
+    land_dir.mkdir('my.cnf')  # can't be written
+    writer = DirectoryWriter(str(land_dir), threads=2)
+    writer.write('my.cnf', u'foo')
+    with pytest.raises(EnvironmentError):
+        writer.close()
+
+
+def test_writer_durable(tmpdir, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: synced.append(fd) or fsync(fd))
+    land_dir = str(tmpdir.join('build'))
+    writer = DirectoryWriter(land_dir, durable=True)
+    for path in ('prod/my.cnf', 'prod/production.ini', 'dev/my.cnf'):
+        writer.write(path, u'foo')
+    writer.close()
+    # every file, the manifest and every directory once
+    assert len(synced) == 3 + 1 + 3
+
+    del synced[:]
+    writer = DirectoryWriter(land_dir)
+    writer.write('prod/my.cnf', u'bar')
+    writer.close()
+    assert synced == []
+
+
+def archive(format, files):
+    f = io.BytesIO()
+    writer = ArchiveWriter(f, format)
+    for path, content in files:
+        writer.write(path, content)
+    writer.close()
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('format', ArchiveWriter.formats)
+def test_archive_writer(format):
+    files = [('dev/my.cnf', u'foo'), ('prod/main/my.cnf', u'b\xe4r')]
+    data = archive(format, files)
+    # the same files always give the same bytes
+    time.sleep(0.01)
+    assert archive(format, files) == data
+
+    if format == 'zip':
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            assert z.namelist() == ['dev/my.cnf', 'prod/main/my.cnf']
+            assert z.read('prod/main/my.cnf') == u'b\xe4r'.encode('utf-8')
+    else:
+        with tarfile.open(fileobj=io.BytesIO(data)) as t:
+            assert t.getnames() == ['dev/my.cnf', 'prod/main/my.cnf']
+            assert t.getmember('dev/my.cnf').mtime == 0
+            assert t.extractfile('prod/main/my.cnf').read() == u'b\xe4r'.encode('utf-8')
+
+
+@pytest.mark.parametrize('filename,expected', (
+    ('-', 'tar'), ('build.tar', 'tar'), ('build.tar.gz', 'tar.gz'), ('build.tgz', 'tar.gz'),
+    ('build.zip', 'zip'),
+))
+def test_archive_format_of(filename, expected):
+    assert ArchiveWriter.format_of(filename) == expected
+
+
+def test_archive_format_of_unknown():
+    with pytest.raises(ValueError):
+        ArchiveWriter.format_of('build.rar')
@@ -1,5 +1,8 @@
+import os
 import pytest
 
+from confgen.view import Renderer
+
 
 @pytest.mark.parametrize("path, expected", (
     (
@@ -61,3 +64,74 @@ def test_render_service(confgen_single_service, renderer_singleservice, path, ex
     confgen = confgen_single_service
     renderer = renderer_singleservice
     assert renderer.service(confgen.root.by_path(path), anon_service=True) == expected
+
+
+def test_bytecode_cache(simplerepo, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    renderer = Renderer(home=simplerepo, cache_dir=cache_dir)
+    assert renderer.warm() == 3
+    assert len(os.listdir(cache_dir)) == 3
+
+    # a fresh renderer loads the compiled templates instead of compiling them again
+    renderer = Renderer(home=simplerepo, cache_dir=cache_dir)
+    renderer.jinja_environ.compile = None
+    assert renderer.jinja_environ.get_template('api/my.cnf')
+
+
+def test_template_dependencies(simplerepo):
+    templates = os.path.join(simplerepo, 'templates')
+    with open(os.path.join(templates, 'base.j2'), 'w') as f:
+        f.write('{% block body %}{% endblock %} {% include "footer.j2" %}')
+    with open(os.path.join(templates, 'footer.j2'), 'w') as f:
+        f.write('{{ secret }}')
+    with open(os.path.join(templates, 'api', 'my.cnf'), 'w') as f:
+        f.write('{% extends "base.j2" %}{% block body %}{{ mysql }}{% endblock %}')
+    renderer = Renderer(home=simplerepo)
+
+    used, variables = renderer.dependencies('api/my.cnf')
+    assert sorted(used) == ['api/my.cnf', 'base.j2', 'footer.j2']
+    assert variables == {'mysql', 'secret'}
+
+
+def test_template_dependencies_unknown(simplerepo):
+    with open(os.path.join(simplerepo, 'templates', 'api', 'my.cnf'), 'w') as f:
+        f.write('{% include SERVICE.name + ".j2" %}')
+    renderer = Renderer(home=simplerepo)
+    assert renderer.dependencies('api/my.cnf') is None
+    assert renderer.fingerprint('api/my.cnf', None) is None
+
+
+def test_fingerprint(confgen, renderer):
+    node = confgen.root.by_path('/dev/qa1/webapp')
+    entry = renderer.fingerprint('webapp/production.ini', node)
+    assert entry['templates'] == ['webapp/production.ini']
+    assert entry['inventory'] == {'mysql': '/dev/qa1', 'secret': '/', 'STAGE': '/dev'}
+    # the same inventory gives the same fingerprint, another one a different one
+    assert renderer.fingerprint('webapp/production.ini', node) == entry
+    other = confgen.root.by_path('/dev/qa2/webapp')
+    assert renderer.fingerprint('webapp/production.ini', other)['fingerprint'] != entry['fingerprint']
+
+
+def test_templates_scanned_once(confgen, renderer, monkeypatch):
+    with open(os.path.join(renderer.home, 'templates', 'api', 'my.cnf.swp'), 'w') as f:
+        f.write('ignored')
+    assert renderer.scan() == {
+        '': [],
+        'api': [('my.cnf', 'api/my.cnf')],
+        'webapp': [('my.cnf', 'webapp/my.cnf'), ('production.ini', 'webapp/production.ini')],
+    }
+    monkeypatch.setattr(os, 'listdir', None)
+    monkeypatch.setattr('confgen.view.scandir', None)
+    assert renderer.templates(confgen.root.by_path('/prod/multiapp/api')) == [('my.cnf', 'api/my.cnf')]
+    assert renderer.templates(confgen.root.by_path('/dev/qa1/api')) == [('my.cnf', 'api/my.cnf')]
+    with pytest.raises(OSError):
+        renderer.templates(confgen.root.by_path('/dev/qa1'))
+
+
+def test_templates_compiled_once(renderer):
+    renderer.prepare()
+    assert sorted(renderer._compiled) == ['api/my.cnf', 'webapp/my.cnf', 'webapp/production.ini']
+    template = renderer.template('api/my.cnf')
+    assert renderer.template('api/my.cnf') is template
+    renderer.reset()
+    assert renderer._compiled == {}
@@ -0,0 +1,57 @@
+import re
+import pytest
+
+from confgen.search import SearchIndex, required_literals
+
+
+@pytest.mark.parametrize('pattern,expected', (
+    ('mysql', ['mysql']),
+    ('^/dev/', ['/dev/']),
+    ('my_value$', ['my_value']),
+    ('1.0', ['1', '0']),
+    (r'1\.0', ['1.0']),
+    ('mysqlx?_version', ['mysql', '_version']),
+    ('mysql+host', ['mysql', 'host']),
+    ('ab{2}cd', ['a', 'cd']),
+    ('secret[0-9]+pass', ['secret', 'pass']),
+    ('prod(uction)?main', ['prod', 'main']),
+    (r'\d+mysql\w', ['mysql']),
+    ('prod|dev', []),
+    ('(?i)mysql', []),
+    (r'my\x73ql', ['my', 'ql']),
+    (r'my\163ql', ['my', 'ql']),
+    (r'my\u0073ql', ['my', 'ql']),
+    (r'my\N{LATIN SMALL LETTER S}ql', ['my', 'ql']),
+    (r'(m)\1ysql', ['ysql']),
+))
+def test_required_literals(pattern, expected):
+    assert required_literals(pattern) == expected
+
+
+ITEMS = [
+    ('mysql', '1.0'),
+    ('mysql_version', '5.7'),
+    ('secret', 'password'),
+    ('new_key', 'my_value'),
+    ('dburi', 'mysql://mysql@prod'),
+    ('app_name', 'confgen'),
+]
+
+
+@pytest.mark.parametrize('pattern', (
+    'mysql', '^mysql$', 'sql_v', 'my_value', '1.0', r'1\.0', 'prod|dev', '(?i)MYSQL',
+    'pass[a-z]+d', 'x?_name', '@prod$', 'nothing-like-it', 'con(f|g)gen',
+    r'my\x73ql', r'my\163ql', r'my\u0073ql', r'\x6dysql', r'pa(s)\1word', r'\061\.0',
+))
+def test_search_index_matches_full_scan(pattern):
+    index = SearchIndex(list(range(len(ITEMS))), ITEMS)
+    rgx = re.compile(pattern)
+    expected = [n for n, fields in enumerate(ITEMS) if any(rgx.search(f) for f in fields)]
+    assert index.search(rgx) == expected
+
+
+def test_search_index_narrows_candidates():
+    index = SearchIndex(list(range(len(ITEMS))), ITEMS)
+    assert list(index.candidates('secret')) == [2]
+    assert list(index.candidates('mysql')) == [0, 1, 4]
+    assert list(index.candidates('1.0')) == list(range(len(ITEMS)))
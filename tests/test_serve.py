@@ -0,0 +1,91 @@
+import os
+import threading
+from os.path import join
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # python 2
+    from urllib2 import urlopen, HTTPError
+
+import pytest
+
+from confgen.serve import ConfigServer, make_server
+
+
+def edit(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    # make sure the change is seen even within the mtime resolution
+    os.utime(path, (1, 1))
+
+
+@pytest.fixture
+def app(confgen):
+    app = ConfigServer(confgen, cache_size=2, interval=0)
+    return app
+
+
+def test_serve_get(app):
+    assert app.get('/dev/qa1/webapp/production.ini') == (200, b'4.0 password qa1 qa2')
+    assert app.get('/dev/qa1/api/my.cnf?x=1') == (200, b'/ dev qa1 api')
+    assert app.get('/dev/qa1/nope/my.cnf')[0] == 404
+    assert app.get('/dev/qa1/my.cnf')[0] == 404
+    assert app.get('/dev/qa1/api/production.ini')[0] == 404
+
+
+def test_serve_service_without_templates(app):
+    os.rename(join(app.confgen.home, 'templates', 'api'), join(app.confgen.home, 'api'))
+    app.confgen.renderer.reset()
+    assert app.get('/dev/qa1/api/my.cnf')[0] == 404
+    assert app.get('/dev/qa1/webapp/my.cnf') == (200, b'/ dev qa1 webapp')
+
+
+def test_serve_lru_cache(app, monkeypatch):
+    rendered = []
+    render_template = app.confgen.renderer.render_template
+    monkeypatch.setattr(app.confgen.renderer, 'render_template',
+                        lambda path, node: rendered.append(node.path) or
+                        render_template(path, node))
+    for url in ('/dev/qa1/api/my.cnf', '/dev/qa2/api/my.cnf', '/dev/qa1/api/my.cnf',
+                '/prod/main/webapp/my.cnf', '/dev/qa1/api/my.cnf', '/dev/qa2/api/my.cnf'):
+        assert app.get(url)[0] == 200
+    assert rendered == ['/dev/qa1/api', '/dev/qa2/api', '/prod/main/webapp', '/dev/qa2/api']
+
+
+def test_serve_invalidates_changed_outputs(app):
+    home = app.confgen.home
+    assert app.get('/dev/qa1/webapp/production.ini') == (200, b'4.0 password qa1 qa2')
+    assert app.get('/dev/qa1/api/my.cnf') == (200, b'/ dev qa1 api')
+
+    edit(join(home, 'inventory', 'dev', 'qa1', 'config.yaml'), 'mysql: 5.0\n')
+    assert app.get('/dev/qa1/webapp/production.ini') == (200, b'5.0 password qa1 qa2')
+    assert ('/dev/qa1/api', 'my.cnf') not in app.cache
+
+    edit(join(home, 'templates', 'api', 'my.cnf'), '{{ SERVICE }}')
+    assert app.get('/dev/qa1/api/my.cnf') == (200, b'api')
+
+
+def test_serve_render_error(app):
+    edit(join(app.confgen.home, 'templates', 'api', 'my.cnf'), '{{ missing }}')
+    status, body = app.get('/dev/qa1/api/my.cnf')
+    assert status == 500
+    assert b"'missing' is undefined" in body
+
+
+def test_serve_http(app):
+    server = make_server(app, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        response = urlopen(url + '/prod/main/webapp/my.cnf')
+        assert response.read() == b'/ prod main webapp'
+        assert response.headers['Content-Type'] == 'text/plain; charset=utf-8'
+        with pytest.raises(HTTPError) as e:
+            urlopen(url + '/prod/main/nope')
+        assert e.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
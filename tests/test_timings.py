@@ -0,0 +1,47 @@
+import json
+import os
+
+from confgen import cli
+from confgen.timings import Timings
+
+
+def test_timings_instrument(confgen):
+    assert confgen.timings is None
+    timings = Timings()
+    timings.instrument(confgen)
+    confgen.build()
+
+    report = timings.report(top=2)
+    phases = dict((i['phase'], i) for i in report['phases'])
+    assert phases['render leaf']['calls'] == 9
+    # one leaf shares the output of another
+    assert phases['render template']['calls'] == 13
+    assert phases['write']['calls'] == 14
+    assert phases['inventory merge']['calls'] == 1
+    assert len(report['slowest_templates']) == 2
+    assert len(report['slowest_leaves']) == 2
+    assert json.loads(timings.format('json'))['phases']
+    assert 'slowest leaves' in timings.format('table')
+
+
+def test_timings_parallel_build(confgen):
+    timings = Timings()
+    timings.instrument(confgen)
+    confgen.build(jobs=3)
+    # workers send what they recorded back, without what the parent did before forking
+    report = timings.report(top=20)
+    phases = dict((i['phase'], i) for i in report['phases'])
+    assert phases['render leaf']['calls'] == 9
+    assert phases['inventory merge']['calls'] == 1
+    assert len(report['slowest_leaves']) == 9
+
+
+def test_timings_cli(runner, simplerepo, tmpdir):
+    profile = str(tmpdir.join('build.prof'))
+    cmd = runner.invoke(cli.cli, ['--ct-home', simplerepo,
+                                  '--config', os.path.join(simplerepo, 'confgen.yaml'),
+                                  '--timings', 'table', '--profile', profile,
+                                  'build', '--jobs', '1'])
+    assert cmd.exit_code == 0
+    assert 'render template' in cmd.output
+    assert os.path.isfile(profile)
@@ -0,0 +1,105 @@
+import os
+from os.path import join
+
+import pytest
+
+from confgen.output import Manifest, content_hash
+from confgen.view import RenderError
+from confgen.watch import Watcher
+
+
+def build_file(confgen, path):
+    return join(confgen.home, confgen.build_dir, path)
+
+
+def touch_all(confgen):
+    # mark every output so we can tell which ones were written again
+    land_dir = join(confgen.home, confgen.build_dir)
+    for root, dirs, files in os.walk(land_dir):
+        for f in files:
+            os.utime(join(root, f), (1, 1))
+
+
+def rewritten(confgen):
+    land_dir = join(confgen.home, confgen.build_dir)
+    return {os.path.relpath(join(root, f), land_dir)
+            for root, dirs, files in os.walk(land_dir) for f in files
+            if not f.startswith('.') and os.stat(join(root, f)).st_mtime != 1}
+
+
+def edit(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_watch_inventory_change(confgen):
+    watcher = Watcher(confgen)
+    confgen.build()
+    touch_all(confgen)
+
+    edit(join(confgen.home, 'inventory', 'dev', 'qa1', 'config.yaml'), 'mysql: 5.0\n')
+    changed = watcher.poll()
+    assert changed == {join(confgen.home, 'inventory', 'dev', 'qa1', 'config.yaml')}
+    assert watcher.affected(changed) == {'/dev/qa1/webapp': None, '/dev/qa1/api': None}
+    assert watcher.rebuild(changed) == 1
+    assert rewritten(confgen) == {'dev/qa1/webapp/production.ini'}
+    assert open(build_file(confgen, 'dev/qa1/webapp/production.ini')).read() == \
+        "5.0 password qa1 qa2"
+    assert watcher.poll() == set()
+
+
+def test_watch_template_change(confgen):
+    watcher = Watcher(confgen)
+    confgen.build()
+    touch_all(confgen)
+
+    edit(join(confgen.home, 'templates', 'api', 'my.cnf'), '{{ SERVICE }}')
+    changed = watcher.poll()
+    assert watcher.affected(changed) == {
+        '/prod/multiapp/api': {'my.cnf'},
+        '/prod/staging/api': {'my.cnf'},
+        '/dev/qa1/api': {'my.cnf'},
+        '/dev/qa2/api': {'my.cnf'},
+    }
+    assert watcher.rebuild(changed) == 4
+    assert rewritten(confgen) == {
+        'prod/multiapp/api/my.cnf', 'prod/staging/api/my.cnf',
+        'dev/qa1/api/my.cnf', 'dev/qa2/api/my.cnf'}
+    assert open(build_file(confgen, 'dev/qa2/api/my.cnf')).read() == "api"
+
+
+def test_watch_render_error(confgen):
+    watcher = Watcher(confgen)
+    confgen.build()
+
+    # the dev leaves are rewritten before the prod ones fail
+    edit(join(confgen.home, 'templates', 'api', 'my.cnf'),
+         "{% if STAGE|string == 'prod' %}{{ missing }}{% endif %}{{ SERVICE }}")
+    with pytest.raises(RenderError):
+        watcher.rebuild(watcher.poll())
+    assert open(build_file(confgen, 'dev/qa1/api/my.cnf')).read() == "api"
+    entries = Manifest(join(confgen.home, confgen.build_dir)).load().entries
+    assert entries['dev/qa1/api/my.cnf']['sha1'] == content_hash(b'api')
+
+
+def test_watch_template_removed(confgen):
+    watcher = Watcher(confgen)
+    confgen.build()
+
+    os.unlink(join(confgen.home, 'templates', 'webapp', 'production.ini'))
+    watcher.rebuild(watcher.poll())
+    assert not os.path.exists(build_file(confgen, 'prod/main/webapp/production.ini'))
+    assert os.path.exists(build_file(confgen, 'prod/main/webapp/my.cnf'))
+
+
+def test_watch_config_change(confgen):
+    watcher = Watcher(confgen)
+    confgen.build()
+
+    with open(confgen.config_path) as f:
+        config = f.read()
+    edit(confgen.config_path, config.replace('qa2: # cluster', 'qa3: # cluster'))
+    watcher.rebuild(watcher.poll())
+    assert watcher.confgen is not confgen
+    assert os.path.exists(build_file(confgen, 'dev/qa3/api/my.cnf'))
+    assert not os.path.exists(build_file(confgen, 'dev/qa2'))